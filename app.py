@@ -1,17 +1,119 @@
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.chains.llm import LLMChain, PromptTemplate
 from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.globals import set_llm_cache
+from langchain.schema.messages import get_buffer_string
+import asyncio
 import chainlit as cl
+import contextvars
 import os
+import threading
+from clients import use_pool
+from embedding_cache import CachedEmbeddings
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+from scheduler import request_context, scheduler
 template = """{question}
 """
 
 os.environ["ASSISTANT_ID"] = 'asst_MQ6N7UnG0FBgoQN62UY9xEel'
 
+# Opt-in cache of complete responses, shared by every session
+response_cache = None
+if os.environ.get("RESPONSE_CACHE"):
+  similarity = os.environ.get("RESPONSE_CACHE_SIMILARITY")
+  response_cache = ResponseCache(
+    os.environ.get("RESPONSE_CACHE_PATH", ".response_cache.sqlite3"),
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 24 * 3600)),
+    embeddings=CachedEmbeddings(use_pool(OpenAIEmbeddings())) if similarity else None,
+    similarity=float(similarity) if similarity else None,
+  )
+  set_llm_cache(response_cache)
+
+# Identical questions asked at the same time share one LLM call
+single_flight = SingleFlight()
+
+
+class SharedCallbacks(BaseCallbackHandler):
+  """
+  Passes the callback events of a shared LLM call on to the handler of every
+  session waiting for it, in the context of that session, so each of them
+  shows the steps of the call. Sessions that join late get the events so far
+  first.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._events = []
+    self._subscribers = []
+
+  def add(self, handler: BaseCallbackHandler):
+    # Subscribes `handler` right away; the returned coroutine replays the events so far
+    subscriber = (contextvars.copy_context(), handler, threading.Lock())
+    with self._lock:
+      self._subscribers.append(subscriber)
+      events = list(self._events)
+      # Live events wait until the events so far are replayed
+      subscriber[2].acquire()
+    return self._replay(subscriber, events)
+
+  async def _replay(self, subscriber, events):
+    try:
+      # The chainlit handler blocks until its message is sent by the event loop
+      await asyncio.to_thread(lambda: [self._send(subscriber, *event) for event in events])
+    finally:
+      subscriber[2].release()
+
+  def _event(self, name, *args, **kwargs):
+    with self._lock:
+      self._events.append((name, args, kwargs))
+      subscribers = list(self._subscribers)
+    for subscriber in subscribers:
+      with subscriber[2]:
+        try:
+          self._send(subscriber, name, args, kwargs)
+        except Exception as e:
+          # As langchain does, a failing handler does not stop the others
+          print(f"Error in {type(subscriber[1]).__name__}.{name} callback: {e!r}")
+
+  @staticmethod
+  def _send(subscriber, name, args, kwargs):
+    context, handler, _ = subscriber
+    try:
+      context.run(getattr(handler, name), *args, **kwargs)
+    except NotImplementedError:
+      if name != "on_chat_model_start":
+        raise
+      # What langchain does for handlers without chat model events
+      serialized, messages = args
+      context.run(
+        handler.on_llm_start, serialized, [get_buffer_string(m) for m in messages], **kwargs
+      )
+
+
+def _forward(name):
+  def forward(self, *args, **kwargs):
+    self._event(name, *args, **kwargs)
+  return forward
+
+
+for _name in (
+  "on_llm_start", "on_chat_model_start", "on_llm_new_token", "on_llm_end", "on_llm_error",
+  "on_chain_start", "on_chain_end", "on_chain_error", "on_tool_start", "on_tool_end",
+  "on_tool_error", "on_text", "on_agent_action", "on_agent_finish",
+  "on_retriever_start", "on_retriever_end", "on_retriever_error",
+):
+  setattr(SharedCallbacks, _name, _forward(_name))
+
+# Callbacks of the calls in flight, by single flight key
+shared_callbacks = {}
+
 @cl.on_chat_start
 def main():
   # Instantiate the chain for that user session
   prompt = PromptTemplate(template=template, input_variables=["question"])
-  llm_chain = LLMChain(prompt=prompt, llm=ChatOpenAI(temperature=0), verbose=True)  
+  llm_chain = LLMChain(prompt=prompt, llm=use_pool(ChatOpenAI(temperature=0)), verbose=True)  
   
   # Store the chain in the user session
   cl.user_session.set("llm_chain", llm_chain)
@@ -21,10 +123,38 @@ def main():
 async def on_message(message: cl.Message):
     chain = cl.user_session.get("llm_chain")  # type: LLMChain
 
-    res = await chain.arun(
-        question=message.content, callbacks=[cl.LangchainCallbackHandler()]
+    llm = chain.llm  # type: ChatOpenAI
+    key = single_flight.key(
+        prompt=chain.prompt.format(question=message.content),
+        model=llm.model_name,
+        temperature=llm.temperature,
     )
+    # langchain looks the response cache up on the calling thread, and it embeds
+    # prompts and writes SQLite, so with it the chain runs on a worker thread
+    run = cl.make_async(chain.run) if response_cache is not None else chain.arun
+    # Sessions that join the call of another one still get its steps. They
+    # subscribe and join without giving way to other tasks, so the call
+    # cannot end in between
+    callbacks = shared_callbacks.setdefault(key, SharedCallbacks())
+    replay = asyncio.create_task(callbacks.add(cl.LangchainCallbackHandler()))
+
+    async def call():
+        try:
+            return await run(question=message.content, callbacks=[callbacks])
+        finally:
+            # Before the flight ends, so a later question starts with new callbacks
+            if shared_callbacks.get(key) is callbacks:
+                del shared_callbacks[key]
+
+    with request_context(session=cl.user_session.get("id")):
+        res = await single_flight.do(key, call)
+    await replay
 
     await cl.Message(content=res).send()
+
+    if response_cache is not None:
+        print("RESPONSE CACHE", response_cache.stats())
+    print("SINGLE FLIGHT", single_flight.stats())
+    print("SCHEDULER", scheduler.stats())
   
   
\ No newline at end of file
@@ -1,7 +1,6 @@
 import json
 import os
 from typing import Dict, Optional
-from openai import AsyncOpenAI
 from openai.types.beta import Thread
 from openai.types.beta.threads import (
     MessageContentImageFile,
@@ -12,10 +11,18 @@ import chainlit as cl
 from chainlit.context import context
 from create_assistant import tools
 from tools import handle_image_history
+from run_tracker import RunTracker
+from tool_executor import ToolExecutor
+from clients import get_async_client
+from scheduler import request_context
 
 api_key = os.environ.get("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=api_key)
+client = get_async_client(api_key)
 assistant_id = os.environ.get("ASSISTANT_ID")
+# DALL-E and GPT-vision calls take seconds, give them more room than the rest
+tool_executor = ToolExecutor(
+    tools, max_workers=8, timeout=60, timeouts={"GenerateImage": 120}
+)
 
 async def process_thread_message(
     message_references: Dict[str, cl.Message], thread_message: ThreadMessage
@@ -119,36 +126,20 @@ async def run_conversation(message_from_ui: cl.Message):
     await loader_msg.send()
 
     # Create the run
-    run = await client.beta.threads.runs.create(
-        thread_id=thread.id, assistant_id=assistant_id
-    )
+    tracker = RunTracker(client, thread.id)
+    await tracker.create(assistant_id)
 
     message_references = {}  # type: Dict[str, cl.Message]
-    tool_outputs = []
-    # Periodically check for updates
-    while True:
-        run = await client.beta.threads.runs.retrieve(
-            thread_id=thread.id, run_id=run.id
-        )
+    # Follow the run until it finishes
+    async for update in tracker.updates():
+        run = update.run
 
-        # Fetch the run steps
-        run_steps = await client.beta.threads.runs.steps.list(
-            thread_id=thread.id, run_id=run.id, order="asc"
-        )
-        
-        for step in run_steps.data:
-            # Fetch step details
-            run_step = await client.beta.threads.runs.steps.retrieve(
-                thread_id=thread.id, run_id=run.id, step_id=step.id
-            )
+        for thread_message in update.messages.values():
+            # Update message content in the Chainlit UI
+            await process_thread_message(message_references, thread_message)
+
+        for run_step in update.steps:
             step_details = run_step.step_details
-            # Update step content in the Chainlit UI
-            if step_details.type == "message_creation":
-                thread_message = await client.beta.threads.messages.retrieve(
-                    message_id=step_details.message_creation.message_id,
-                    thread_id=thread.id,
-                )
-                await process_thread_message(message_references, thread_message)
 
             if step_details.type == "tool_calls":
                 print("TOOL CALLS", step_details)
@@ -194,14 +185,6 @@ async def run_conversation(message_from_ui: cl.Message):
                             )
                             
                             await message_references[tool_output_id].update()
-                            
-                        tool_outputs.append(
-                                {
-                                    "output": tool_call.code_interpreter.outputs or "",
-                                    "tool_call_id": tool_call.id,
-                                }
-                            )
-                        print("TOOL code OUTPUTS", tool_outputs)    
                         
                     elif tool_call.type == "retrieval":
                         if not tool_call.id in message_references:
@@ -213,7 +196,6 @@ async def run_conversation(message_from_ui: cl.Message):
                             await message_references[tool_call.id].send()
                             
                     elif tool_call.type == "function":
-                        tool_map = {tool.name: tool for tool in tools if hasattr(tool, "name")}
                         function_name = tool_call.function.name
                         function_args = json.loads(tool_call.function.arguments)
 
@@ -226,12 +208,6 @@ async def run_conversation(message_from_ui: cl.Message):
                             )
                             await message_references[tool_call.id].send()
 
-                            tool_output = tool_map[function_name].invoke(json.loads(tool_call.function.arguments))
-                            print("ARGUEMENTSSSSS", tool_call.function.arguments)
-                            print(function_name, function_args, tool_output, end="\n\n")
-                            tool_outputs.append(
-                                {"output": tool_output, "tool_call_id": tool_call.id}
-                            )
                         tool_output_id = tool_call.id + "output"
 
                         if not tool_output_id in message_references:
@@ -247,16 +223,16 @@ async def run_conversation(message_from_ui: cl.Message):
                                 str(tool_call.function.output) if hasattr(tool_call.function, "output") else ""
                             )
                             
-                            await message_references[tool_output_id].update()    
-                        
-            if run.status == "requires_action" and run.required_action.type == "submit_tool_outputs":
-                print("TOOL OUTPUTS", tool_outputs)
-                await client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread.id,
-                    run_id=run.id,
-                    tool_outputs=tool_outputs,
+                            await message_references[tool_output_id].update()
+
+        if run.status == "requires_action" and run.required_action.type == "submit_tool_outputs":
+            # Run every requested function at once and submit all outputs together
+            with request_context(session=cl.user_session.get("id")):
+                tool_outputs = await tool_executor.run(
+                    run.required_action.submit_tool_outputs.tool_calls
                 )
+            print("TOOL OUTPUTS", tool_outputs)
+            await tracker.submit_tool_outputs(tool_outputs)
 
-        await cl.sleep(1)  # Refresh every second
-        if run.status in ["cancelled", "failed", "completed", "expired"]:
-            break
\ No newline at end of file
+    print("RUN API CALLS", tracker.stats())
+    print("TOOL LATENCY", tool_executor.stats())
@@ -1,18 +1,35 @@
-from openai import AsyncClient
+import asyncio
 import json
-import ast
 import os
+from typing import Annotated, Literal, Optional
 import chainlit as cl
 from chainlit.prompt import Prompt, PromptMessage
+from clients import get_async_client
+from function_registry import ArgumentError, FunctionRegistry, error_response
+from history import HistoryManager, forget_session, history_stats
+from scheduler import request_context, scheduler
+from single_flight import SingleFlight
+from streaming import TokenStreamBuffer, stream_stats
 
-openai_client = AsyncClient(api_key=os.environ.get("OPENAI_API_KEY"))
+openai_client = get_async_client(os.environ.get("OPENAI_API_KEY"))
+# Sessions sending the same messages at the same time share one completion
+single_flight = SingleFlight()
 
 MAX_ITER = 5
+# Token budget of the history sent on every completion
+HISTORY_TOKENS = int(os.environ.get("HISTORY_TOKENS", 6000))
+
+
+registry = FunctionRegistry()
 
 
 # Example dummy function hard coded to return the same weather
 # In production, this could be your backend API or an external API
-def get_current_weather(location, unit):
+@registry.register(pure=True)
+def get_current_weather(
+    location: Annotated[str, "The city and state, e.g. San Francisco, CA"],
+    unit: Optional[Literal["celsius", "fahrenheit"]] = None,
+):
     """Get the current weather in a given location"""
     unit = unit or "Farenheit"
     weather_info = {
@@ -26,8 +43,14 @@ def get_current_weather(location, unit):
 
     return json.dumps(weather_info)
 
+@registry.register(
+    description="Get the taxi booking information. Ask the questions one by one as the user is a senior citizen and may not be able to answer all the questions at once"
+)
 def get_taxi_booking_information(
-    pickup_location, dropoff_location, pickup_time, number_of_passengers
+    pickup_location: Annotated[str, "The pickup location in the city"],
+    dropoff_location: Annotated[str, "The dropoff location. Should always be a valid address."],
+    pickup_time: Annotated[str, "The pickup time. should always be a valid time. if not specified then the current time is given as NOW"],
+    number_of_passengers: Annotated[int, "The number of passengers"],
 ):
     """Get the taxi booking information"""
     booking_info = {
@@ -41,6 +64,7 @@ def get_taxi_booking_information(
 
     return json.dumps(booking_info)
 
+@registry.register(pure=True)
 def get_user_information():
     """Get the user information, such as the name, city, and state, home address, work address, etc. This function can be called at the start of the conversation to get the user information."""
     user_info = {
@@ -54,79 +78,31 @@ def get_user_information():
     return json.dumps(user_info)
 
 
-functions = [
-    {
-        "name": "get_current_weather",
-        "description": "Get the current weather in a given location",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "location": {
-                    "type": "string",
-                    "description": "The city and state, e.g. San Francisco, CA",
-                },
-                "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
-            },
-            "required": ["location"],
-        },
-    },
-    {
-        "name": "get_taxi_booking_information",
-        "description": "Get the taxi booking information. Ask the questions one by one as the user is a senior citizen and may not be able to answer all the questions at once",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "pickup_location": {
-                    "type": "string",
-                    "description": "The pickup location in the city",
-                },
-                "dropoff_location": {
-                    "type": "string",
-                    "description": "The dropoff location. Should always be a valid address.",
-                },
-                "pickup_time": {
-                    "type": "string",
-                    "description": "The pickup time. should always be a valid time. if not specified then the current time is given as NOW",
-                },
-                "number_of_passengers": {
-                    "type": "integer",
-                    "description": "The number of passengers",
-                }
-            },
-            "required": ["pickup_location", "dropoff_location", "pickup_time", "number_of_passengers"],
-        },
-    },
-    {
-        "name": "get_user_information",
-        "description": "Get the user information, such as the name, city, and state, home address, work address, etc. This function can be called at the start of the conversation to get the user information.",
-        "parameters": {
-            "type": "object",
-            "properties": {},
-        },
-    }
-]
+functions = registry.schemas()
 
 
 async def process_new_delta(
-    new_delta, openai_message, content_ui_message, function_ui_message
+    new_delta, openai_message, content_stream, function_stream
 ):
     if new_delta.role:
         openai_message["role"] = new_delta.role
 
     new_content = new_delta.content or ""
     openai_message["content"] += new_content
-    await content_ui_message.stream_token(new_content)
+    await content_stream.push(new_content)
     if new_delta.function_call:
         if new_delta.function_call.name:
             openai_message["function_call"] = {"name": new_delta.function_call.name}
-            await content_ui_message.send()
+            await content_stream.flush()
+            await content_stream.message.send()
             function_ui_message = cl.Message(
                 author=new_delta.function_call.name,
                 content="",
-                parent_id=content_ui_message.id,
+                parent_id=content_stream.message.id,
                 language="json",
             )
-            await function_ui_message.stream_token(new_delta.function_call.name)
+            function_stream = TokenStreamBuffer(function_ui_message)
+            await function_stream.push(new_delta.function_call.name)
 
         if new_delta.function_call.arguments:
             if "arguments" not in openai_message["function_call"]:
@@ -134,21 +110,31 @@ async def process_new_delta(
             openai_message["function_call"][
                 "arguments"
             ] += new_delta.function_call.arguments
-            await function_ui_message.stream_token(new_delta.function_call.arguments)
-    return openai_message, content_ui_message, function_ui_message
+            await function_stream.push(new_delta.function_call.arguments)
+    return openai_message, content_stream, function_stream
 
 
 @cl.on_chat_start
 def start_chat():
     cl.user_session.set(
         "message_history",
-        [{"role": "system", "content": "You are a helpful coding assistant. You are specialised to work with coders and provide detailed implementations"}],
+        HistoryManager(
+            "You are a helpful coding assistant. You are specialised to work with coders and provide detailed implementations",
+            max_tokens=HISTORY_TOKENS,
+            model="gpt-4-1106-preview",
+            session_id=cl.user_session.get("id"),
+        ),
     )
 
 
+@cl.on_chat_end
+def end_chat():
+    forget_session(cl.user_session.get("id"))
+
+
 @cl.on_message
 async def run_conversation(message: cl.Message):
-    message_history = cl.user_session.get("message_history")
+    message_history = cl.user_session.get("message_history")  # type: HistoryManager
     message_history.append({"role": "user", "content": message.content})
 
     cur_iter = 0
@@ -156,8 +142,9 @@ async def run_conversation(message: cl.Message):
     while cur_iter < MAX_ITER:
         # OpenAI call
         openai_message = {"role": "", "content": ""}
-        function_ui_message = None
+        function_stream = None
         content_ui_message = cl.Message(content="")
+        content_stream = TokenStreamBuffer(content_ui_message)
 
         await content_ui_message.send()
 
@@ -168,22 +155,49 @@ async def run_conversation(message: cl.Message):
             "temperature": 0,
         }
 
-        stream = await openai_client.chat.completions.create(
-            messages=message_history, stream=True, **settings
+        messages = message_history.messages()
+        stream = single_flight.stream(
+            single_flight.key(messages=messages, **settings),
+            lambda: openai_client.chat.completions.create(
+                messages=messages, stream=True, **settings
+            ),
         )
 
         finish_reason = None
-
-        async for part in stream:
-            new_delta = part.choices[0].delta
-            (
-                openai_message,
-                content_ui_message,
-                function_ui_message,
-            ) = await process_new_delta(
-                new_delta, openai_message, content_ui_message, function_ui_message
-            )
-            finish_reason = part.choices[0].finish_reason
+        arguments_parser = None
+        speculative_call = None
+
+        with request_context(session=cl.user_session.get("id")):
+            async for part in stream:
+                new_delta = part.choices[0].delta
+                (
+                    openai_message,
+                    content_stream,
+                    function_stream,
+                ) = await process_new_delta(
+                    new_delta, openai_message, content_stream, function_stream
+                )
+                finish_reason = part.choices[0].finish_reason
+
+                if new_delta.function_call:
+                    if new_delta.function_call.name:
+                        arguments_parser = registry.parser(new_delta.function_call.name)
+                    arguments_parser.feed(new_delta.function_call.arguments or "")
+                    if arguments_parser.error is not None:
+                        # No need to wait for the rest of a call that is already wrong
+                        openai_message["function_call"].setdefault("arguments", "")
+                        await stream.aclose()
+                        break
+                    function = registry.get(arguments_parser.name)
+                    if arguments_parser.complete and function.pure and speculative_call is None:
+                        speculative_call = asyncio.create_task(
+                            registry.call(arguments_parser.name, arguments_parser.arguments)
+                        )
+
+        await content_stream.close()
+        if function_stream is not None:
+            await function_stream.close()
+        print("STREAMED", content_stream.stats())
 
         prompt = Prompt(
             provider="openai-chat",
@@ -191,7 +205,7 @@ async def run_conversation(message: cl.Message):
                 PromptMessage(
                     formatted=m["content"], name=m.get("name"), role=m["role"]
                 )
-                for m in message_history
+                for m in messages
             ],
             settings=settings,
             completion=content_ui_message.content,
@@ -200,37 +214,37 @@ async def run_conversation(message: cl.Message):
         await content_ui_message.update()
 
         message_history.append(openai_message)
-        if function_ui_message is not None:
-            await function_ui_message.send()
+        if function_stream is not None:
+            await function_stream.message.send()
 
         if finish_reason == "stop":
             break
 
-        elif finish_reason != "function_call":
+        elif finish_reason != "function_call" and (
+            arguments_parser is None or arguments_parser.error is None
+        ):
             raise ValueError(finish_reason)
 
         # if code arrives here, it means there is a function call
         function_name = openai_message.get("function_call", {}).get("name")
-        arguments = ast.literal_eval(
-            openai_message.get("function_call", {}).get("arguments")
+        if speculative_call is not None:
+            function_response = await speculative_call
+        else:
+            try:
+                arguments = arguments_parser.finish()
+            except ArgumentError as e:
+                function_response = error_response(e)
+            else:
+                function_response = await registry.call(function_name, arguments)
+        print(
+            "FUNCTION CALL",
+            function_name,
+            {
+                "speculative": speculative_call is not None,
+                "rejected": arguments_parser.error is not None,
+            },
         )
 
-        if function_name == "get_current_weather":
-            function_response = get_current_weather(
-                location=arguments.get("location"),
-                unit=arguments.get("unit"),
-            )
-        elif function_name == "get_taxi_booking_information":
-            function_response = get_taxi_booking_information(
-                pickup_location=arguments.get("pickup_location"),
-                dropoff_location=arguments.get("dropoff_location"),
-                pickup_time=arguments.get("pickup_time"),
-                number_of_passengers=arguments.get("number_of_passengers"),
-            )
-        elif function_name == "get_user_information":
-            function_response = get_user_information()
-        
-
         message_history.append(
             {
                 "role": "function",
@@ -246,4 +260,10 @@ async def run_conversation(message: cl.Message):
             parent_id=content_ui_message.id,
         ).send()
 
-        cur_iter += 1
\ No newline at end of file
+        cur_iter += 1
+
+    print("HISTORY", message_history.stats())
+    print("HISTORY SESSIONS", history_stats())
+    print("STREAMING", stream_stats())
+    print("SINGLE FLIGHT", single_flight.stats())
+    print("SCHEDULER", scheduler.stats())
\ No newline at end of file
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+from typing import AsyncIterator, Iterable, Optional
+
+_DONE = object()
+
+
+class _Error:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class AsyncBridge:
+    """
+    Iterates a blocking iterable, like the token generator of a streamed
+    llama_index response, on a worker thread and hands its items to the
+    event loop, so waiting for the next token never blocks other sessions.
+
+    At most `max_pending` items wait for the consumer, the worker blocks
+    beyond that. `cancel` (or leaving the `async for` early) stops the worker
+    once its current item arrived and closes the iterable. Time to first
+    item and items per second are measured from `started`, which defaults to
+    the creation of the bridge.
+    """
+
+    def __init__(self, iterable: Iterable, max_pending: int = 64, started: Optional[float] = None):
+        self.iterable = iterable
+        self.max_pending = max_pending
+        self.started = started if started is not None else time.perf_counter()
+        self.first_item_at = None  # type: Optional[float]
+        self.last_item_at = None  # type: Optional[float]
+        self.items = 0
+        self.cancelled = False
+        self._stop = threading.Event()
+        self._slots = threading.Semaphore(max_pending)
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._queue = None  # type: Optional[asyncio.Queue]
+
+    def __aiter__(self) -> AsyncIterator:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator:
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        threading.Thread(target=self._pump, name="async-bridge", daemon=True).start()
+        done = False
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is _DONE or self._stop.is_set():
+                    done = True
+                    return
+                if isinstance(item, _Error):
+                    done = True
+                    raise item.error
+                self._slots.release()
+                now = time.perf_counter()
+                if self.first_item_at is None:
+                    self.first_item_at = now
+                self.last_item_at = now
+                self.items += 1
+                yield item
+        finally:
+            if not done:
+                self.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        self._stop.set()
+        # Wake a consumer waiting for an item the worker will never send
+        if self._loop is not None:
+            self._put(_DONE)
+
+    def _put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is gone, nobody is waiting anymore
+            self._stop.set()
+
+    def _pump(self):
+        iterator = iter(self.iterable)
+        try:
+            for item in iterator:
+                while not self._slots.acquire(timeout=0.1):
+                    if self._stop.is_set():
+                        return
+                if self._stop.is_set():
+                    return
+                self._put(item)
+        except BaseException as e:
+            self._put(_Error(e))
+        finally:
+            # Every exit ends the consumer's iteration, after an error it is never read
+            self._put(_DONE)
+            if self._stop.is_set() and hasattr(iterator, "close"):
+                iterator.close()
+
+    def stats(self) -> dict:
+        if self.first_item_at is None:
+            return {"items": 0, "cancelled": self.cancelled}
+        streaming = self.last_item_at - self.first_item_at
+        return {
+            "items": self.items,
+            "ttft_ms": round((self.first_item_at - self.started) * 1000, 1),
+            "items_per_s": round((self.items - 1) / streaming, 1) if streaming > 0 else None,
+            "total_ms": round((self.last_item_at - self.started) * 1000, 1),
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from scheduler import AsyncScheduledTransport, ScheduledTransport, scheduler
+
+# Connection pool limits, shared by every OpenAI client of the process
+POOL_LIMITS = {
+    "max_connections": int(os.environ.get("OPENAI_MAX_CONNECTIONS", 100)),
+    "max_keepalive_connections": int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20)),
+    "keepalive_expiry": float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 30)),
+}
+
+_lock = threading.Lock()
+_http_client = None  # type: Optional[httpx.Client]
+_async_http_client = None  # type: Optional[httpx.AsyncClient]
+_clients = {}  # type: Dict[Optional[str], OpenAI]
+_async_clients = {}  # type: Dict[Optional[str], AsyncOpenAI]
+
+
+def configure(**limits):
+    """
+    Change the connection pool limits. Only clients created afterwards use
+    them, so call this before the first request.
+    """
+    unknown = set(limits) - set(POOL_LIMITS)
+    if unknown:
+        raise ValueError(f"Unknown pool limits: {', '.join(sorted(unknown))}")
+    POOL_LIMITS.update(limits)
+
+
+def http_client() -> httpx.Client:
+    """
+    The process-wide keep-alive connection pool for synchronous requests.
+    Model calls made through it are rate limited by the scheduler.
+    """
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            transport = httpx.HTTPTransport(limits=httpx.Limits(**POOL_LIMITS))
+            _http_client = httpx.Client(
+                transport=ScheduledTransport(transport, scheduler), follow_redirects=True
+            )
+        return _http_client
+
+
+def async_http_client() -> httpx.AsyncClient:
+    """
+    The process-wide keep-alive connection pool for asynchronous requests.
+    """
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None:
+            transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(**POOL_LIMITS))
+            _async_http_client = httpx.AsyncClient(
+                transport=AsyncScheduledTransport(transport, scheduler), follow_redirects=True
+            )
+        return _async_http_client
+
+
+def get_client(api_key: Optional[str] = None) -> OpenAI:
+    """
+    The synchronous OpenAI client for `api_key` (the OPENAI_API_KEY
+    environment variable when not given), created once per key.
+    """
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    pool = http_client()
+    with _lock:
+        if api_key not in _clients:
+            # The scheduler retries model calls and tells the SDK not to retry
+            # them again, the SDK still retries every other request
+            _clients[api_key] = OpenAI(api_key=api_key, http_client=pool)
+        return _clients[api_key]
+
+
+def get_async_client(api_key: Optional[str] = None) -> AsyncOpenAI:
+    """
+    The asynchronous OpenAI client for `api_key` (the OPENAI_API_KEY
+    environment variable when not given), created once per key.
+    """
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    pool = async_http_client()
+    with _lock:
+        if api_key not in _async_clients:
+            _async_clients[api_key] = AsyncOpenAI(api_key=api_key, http_client=pool)
+        return _async_clients[api_key]
+
+
+def use_pool(model, api_key: Optional[str] = None):
+    """
+    Point a langchain `ChatOpenAI` or `OpenAIEmbeddings` at the shared
+    clients, which it cannot be given through `http_client` for both its
+    synchronous and asynchronous calls.
+    """
+    resource = "embeddings" if hasattr(model, "embed_query") else "chat"
+
+    def endpoint(client):
+        # Keeps the retries the model was configured with, on the shared pool
+        max_retries = getattr(model, "max_retries", None)
+        if max_retries is not None:
+            client = client.with_options(max_retries=max_retries)
+        return client.embeddings if resource == "embeddings" else client.chat.completions
+
+    model.client = endpoint(get_client(api_key))
+    model.async_client = endpoint(get_async_client(api_key))
+    return model
+
+
+def benchmark(requests: int = 50):
+    """
+    Compare a new client per call with the shared registry against a local
+    HTTP stub of the OpenAI API, counting the TCP connections it accepts.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    connections = []
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_GET(self):
+            body = b'{"object": "list", "data": []}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    def run(name, make_client):
+        connections.clear()
+        start = time.perf_counter()
+        for _ in range(requests):
+            make_client().models.list()
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name}: {requests} requests, {len(connections)} connections, "
+            f"{elapsed / requests * 1000:.2f} ms per request"
+        )
+
+    run("client per call", lambda: OpenAI(api_key="stub", base_url=base_url))
+    shared = OpenAI(api_key="stub", base_url=base_url, http_client=http_client())
+    run("shared pool", lambda: shared)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,207 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from typing import BinaryIO, Dict, Optional, Set, Tuple
+
+from langchain.vectorstores import Chroma
+
+from hybrid_retriever import BM25Index
+
+# Written next to a persisted collection once it holds every chunk of its file
+COMPLETE_MARKER = "complete"
+
+
+def file_hash(stream: BinaryIO) -> str:
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(1024 * 1024), b""):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class SharedCollection:
+    def __init__(self, key: str):
+        self.key = key
+        self.store = None  # type: Optional[Chroma]
+        # Why filling the collection failed, set before its events wake the waiters
+        self.error = None  # type: Optional[BaseException]
+        # BM25 index over the same chunks, for hybrid retrieval
+        self.lexical = BM25Index()
+        self.refs = 0
+        self.last_released = time.time()
+        self.resident_bytes = 0
+        # Set once the first batch of chunks is searchable
+        self.first_batch = threading.Event()
+        # Set once every chunk of the file is in the store
+        self.ready = threading.Event()
+
+
+class CollectionManager:
+    """
+    Shares one Chroma collection between every session that uploads the
+    same file, identified by the hash of its content.
+
+    Collections are reference counted. Once nobody has used a collection for
+    `ttl` seconds it is evicted from memory; with `persist_dir` set it stays
+    on disk and is reopened without embedding anything when the file is
+    uploaded again. A discarded collection is deleted once its last session
+    released it.
+    """
+
+    def __init__(self, embeddings, ttl: float = 600, persist_dir: Optional[str] = None):
+        self.embeddings = embeddings
+        self.ttl = ttl
+        self.persist_dir = persist_dir
+        self._lock = threading.Lock()
+        self._collections = {}  # type: Dict[str, SharedCollection]
+        # Discarded collections that sessions still hold
+        self._discarded = set()  # type: Set[SharedCollection]
+        # Every store gets its own collection name, a retry never reuses the one of a failed fill
+        self._generation = 0
+
+    def acquire(self, key: str) -> Tuple[SharedCollection, bool]:
+        """
+        Return the collection for `key` and whether the caller has to fill
+        it, in which case it must call `batch_indexed` as chunks land and
+        `complete` (or `discard` on failure) when it is done. Other sessions
+        can search the collection while it is being filled.
+        """
+        self.sweep()
+        with self._lock:
+            collection = self._collections.get(key)
+            if collection is not None:
+                collection.refs += 1
+                return collection, False
+            collection = self._collections[key] = SharedCollection(key)
+            collection.refs += 1
+            collection.store, complete = self._open(key)
+
+        if complete:
+            try:
+                # The lexical index is not persisted, rebuild it from the stored chunks
+                stored = collection.store._collection.get(include=["documents", "metadatas"])
+                collection.lexical.add_texts(stored["documents"], stored["metadatas"])
+                self._mark_complete(collection)
+            except BaseException as e:
+                # Sessions that joined meanwhile are woken with the error, the caller never got it
+                with self._lock:
+                    collection.refs -= 1
+                self.discard(key, e)
+                raise
+        return collection, not complete
+
+    def batch_indexed(self, key: str):
+        self._collections[key].first_batch.set()
+
+    def complete(self, key: str):
+        collection = self._collections[key]
+        if self.persist_dir is not None:
+            # The marker names the collection, so it is found when the file is uploaded again
+            with open(os.path.join(self.persist_dir, key, COMPLETE_MARKER), "w") as f:
+                f.write(collection.store._collection.name)
+        self._mark_complete(collection)
+
+    def discard(self, key: str, error: Optional[BaseException] = None):
+        """
+        Drop a collection whose filling failed, so the next upload retries.
+        Sessions waiting for it are woken and find `error` on the collection.
+        """
+        with self._lock:
+            collection = self._collections.pop(key, None)
+            if collection is None:
+                return
+            collection.error = error or RuntimeError(f"Filling collection {key} failed")
+            if self.persist_dir is not None:
+                # The store is deleted, the next upload must not reopen it
+                try:
+                    os.remove(os.path.join(self.persist_dir, key, COMPLETE_MARKER))
+                except FileNotFoundError:
+                    pass
+            if collection.refs > 0:
+                self._discarded.add(collection)
+            else:
+                collection.store.delete_collection()
+        collection.first_batch.set()
+        collection.ready.set()
+
+    def release(self, collection: SharedCollection):
+        with self._lock:
+            if collection.refs > 0:
+                collection.refs -= 1
+                collection.last_released = time.time()
+            if collection in self._discarded and collection.refs == 0:
+                self._discarded.remove(collection)
+                collection.store.delete_collection()
+        self.sweep()
+
+    def sweep(self):
+        """
+        Evict every collection that no session used for `ttl` seconds.
+        """
+        now = time.time()
+        with self._lock:
+            expired = [
+                collection
+                for collection in self._collections.values()
+                if collection.refs == 0
+                and collection.ready.is_set()
+                and now - collection.last_released > self.ttl
+            ]
+            for collection in expired:
+                del self._collections[collection.key]
+                # Under the lock: a new upload of the file reopens a collection of the same name
+                if self.persist_dir is None:
+                    collection.store.delete_collection()
+
+        for collection in expired:
+            print(f"Evicted collection {collection.key}")
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Approximate resident bytes of every complete collection in memory,
+        its vectors and chunks in the store and its BM25 index.
+        """
+        with self._lock:
+            return {key: c.resident_bytes for key, c in self._collections.items()}
+
+    def _open(self, key: str) -> Tuple[Chroma, bool]:
+        # Chroma collection names are limited to 63 characters
+        self._generation += 1
+        name = f"qa-{key[:32]}-{self._generation}"
+        if self.persist_dir is None:
+            return Chroma(collection_name=name, embedding_function=self.embeddings), False
+
+        path = os.path.join(self.persist_dir, key)
+        marker = os.path.join(path, COMPLETE_MARKER)
+        complete = os.path.exists(marker)
+        if complete:
+            with open(marker) as f:
+                # Markers written before collections had generations are empty
+                name = f.read() or f"qa-{key[:32]}"
+        elif not any(collection.key == key for collection in self._discarded):
+            # A half written collection from an interrupted upload is rebuilt,
+            # unless the sessions of a failed fill still hold it
+            shutil.rmtree(path, ignore_errors=True)
+        store = Chroma(
+            collection_name=name, embedding_function=self.embeddings, persist_directory=path
+        )
+        return store, complete
+
+    def _mark_complete(self, collection: SharedCollection):
+        collection.resident_bytes = _resident_bytes(collection.store) + collection.lexical.resident_bytes()
+        collection.first_batch.set()
+        collection.ready.set()
+
+
+def _resident_bytes(store: Chroma) -> int:
+    collection = store._collection
+    count = collection.count()
+    if not count:
+        return 0
+    sample = collection.peek(1)
+    dimensions = len(sample["embeddings"][0])
+    documents = collection.get(include=["documents"])["documents"]
+    # float32 vectors, plus the text of every chunk
+    return count * dimensions * 4 + sum(len(document.encode("utf-8")) for document in documents)
@@ -0,0 +1,223 @@
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import tiktoken
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.memory import ConversationBufferMemory
+from langchain.schema import BaseRetriever
+from langchain.schema.messages import BaseMessage, SystemMessage, get_buffer_string
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:"
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    return len(_encoding(model).encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str = "gpt-3.5-turbo") -> str:
+    tokens = _encoding(model).encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return _encoding(model).decode(tokens[:max_tokens]) + "..."
+
+
+def summarize_text(text: str, max_tokens: int = 40, model: str = "gpt-3.5-turbo") -> str:
+    """
+    A cheap extractive summary: the first sentence of `text`, cut down to
+    `max_tokens`. Good enough to remind the model what an older turn was
+    about without paying for an LLM call.
+    """
+    text = " ".join(text.split())
+    first_sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    return truncate_tokens(first_sentence, max_tokens, model)
+
+
+def merge_overlapping(documents: List[Document], min_overlap: int = 20, max_overlap: int = 200):
+    """
+    Drop duplicate chunks and merge chunks whose start repeats the end of
+    another retrieved chunk, as neighbouring chunks of the text splitter do.
+    """
+    merged = []  # type: List[Document]
+    for document in documents:
+        text = document.page_content
+        if any(text in other.page_content for other in merged):
+            continue
+        for i, other in enumerate(merged):
+            joined = _join(other.page_content, text, min_overlap, max_overlap)
+            if joined is None:
+                joined = _join(text, other.page_content, min_overlap, max_overlap)
+            if joined is not None:
+                merged[i] = Document(page_content=joined, metadata=other.metadata)
+                break
+        else:
+            merged.append(document)
+    return merged
+
+
+def _join(first: str, second: str, min_overlap: int, max_overlap: int) -> Optional[str]:
+    for size in range(min(max_overlap, len(first), len(second)), min_overlap - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return None
+
+
+class ContextPacker:
+    """
+    Fits the chat history and the retrieved chunks of a "stuff" chain into
+    `max_tokens`, counted locally with tiktoken.
+
+    History gets at most `history_share` of the budget: the most recent
+    messages are kept verbatim and older ones are folded into a short
+    extractive summary. Retrieved chunks are deduplicated, merged where they
+    overlap and trimmed to whatever budget the history and question left.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 3000,
+        history_share: float = 0.3,
+        summary_tokens: int = 200,
+        model: str = "gpt-3.5-turbo",
+    ):
+        self.max_tokens = max_tokens
+        self.history_tokens = int(max_tokens * history_share)
+        self.summary_tokens = summary_tokens
+        self.model = model
+        # Tokens already folded out of the stored history
+        self.compacted = 0
+        self._reset()
+
+    def _reset(self):
+        self.used = {"history": 0, "documents": 0}
+        self.saved = {"history": 0, "documents": 0}
+
+    def count(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def pack_history(self, messages: List[BaseMessage], record: bool = True) -> List[BaseMessage]:
+        """
+        Pack `messages` into the history budget. With `record` the result
+        counts towards the current request, otherwise the messages are being
+        compacted for storage.
+        """
+        original = sum(self.count(m.content) for m in messages)
+        summary_lines = []
+        if messages and _is_summary(messages[0]):
+            summary_lines = messages[0].content[len(SUMMARY_PREFIX) :].strip().splitlines()
+            messages = messages[1:]
+
+        budget = self.history_tokens - min(self.summary_tokens, self.history_tokens // 2)
+        recent = []  # type: List[BaseMessage]
+        used = 0
+        for message in reversed(messages):
+            tokens = self.count(message.content)
+            if used + tokens > budget:
+                break
+            recent.insert(0, message)
+            used += tokens
+
+        older = messages[: len(messages) - len(recent)]
+        summary_lines += [f"{m.type}: {summarize_text(m.content, 40, self.model)}" for m in older]
+        # The oldest summary lines go first when the summary is over budget
+        while summary_lines and self.count("\n".join(summary_lines)) > self.summary_tokens:
+            summary_lines.pop(0)
+
+        packed = recent
+        if summary_lines:
+            summary = SystemMessage(content=SUMMARY_PREFIX + "\n" + "\n".join(summary_lines))
+            packed = [summary] + recent
+            used += self.count(summary.content)
+
+        if record:
+            self.used["history"] = used
+            self.saved["history"] = self.compacted + max(original - used, 0)
+        else:
+            self.compacted += max(original - used, 0)
+        return packed
+
+    def pack_documents(self, question: str, documents: List[Document]) -> List[Document]:
+        original = sum(self.count(d.page_content) for d in documents)
+        budget = self.max_tokens - self.used["history"] - self.count(question)
+
+        packed = []
+        used = 0
+        for document in merge_overlapping(documents):
+            tokens = self.count(document.page_content)
+            if used + tokens > budget:
+                if budget - used > 50:
+                    text = truncate_tokens(document.page_content, budget - used, self.model)
+                    packed.append(Document(page_content=text, metadata=document.metadata))
+                    used = budget
+                break
+            packed.append(document)
+            used += tokens
+
+        self.used["documents"] = used
+        self.saved["documents"] = max(original - used, 0)
+        return packed
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Tokens used and saved by the last request, then start counting anew.
+        """
+        report = {
+            "used": dict(self.used),
+            "saved": dict(self.saved),
+            "total_saved": sum(self.saved.values()),
+        }
+        self._reset()
+        return report
+
+
+def _is_summary(message: BaseMessage) -> bool:
+    return isinstance(message, SystemMessage) and message.content.startswith(SUMMARY_PREFIX)
+
+
+class PackedConversationMemory(ConversationBufferMemory):
+    """
+    A `ConversationBufferMemory` that hands the chain packed history and
+    stores it packed too, so it stops growing with every turn.
+    """
+
+    packer: Any
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        messages = self.packer.pack_history(self.chat_memory.messages)
+        if not self.return_messages:
+            messages = get_buffer_string(
+                messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix
+            )
+        return {self.memory_key: messages}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+        self.chat_memory.messages = self.packer.pack_history(
+            self.chat_memory.messages, record=False
+        )
+
+
+class PackedRetriever(BaseRetriever):
+    """
+    Passes the documents of `retriever` through `ContextPacker.pack_documents`.
+    """
+
+    retriever: BaseRetriever
+    packer: Any
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        documents = self.retriever.get_relevant_documents(
+            query, callbacks=run_manager.get_child()
+        )
+        return self.packer.pack_documents(query, documents)
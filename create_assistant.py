@@ -1,5 +1,4 @@
 import json
-from openai import AsyncOpenAI
 import asyncio
 import os
 from dotenv import load_dotenv
@@ -9,12 +8,13 @@ from langchain.tools.wolfram_alpha import WolframAlphaQueryRun
 from langchain.utilities.wolfram_alpha import WolframAlphaAPIWrapper
 from langchain.utilities.serpapi import SerpAPIWrapper
 from tools import generate_image_tool, describe_image_tool
+from clients import get_async_client
 
 load_dotenv()
 
 wolfram_api_wrapper = WolframAlphaAPIWrapper(wolfram_alpha_appid=os.environ.get("WOLFRAM_ALPHA_APPID"))
 api_key = os.environ.get("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=api_key)
+client = get_async_client(api_key)
 
 search = SerpAPIWrapper()
 
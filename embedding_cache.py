@@ -0,0 +1,156 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from langchain.schema.embeddings import Embeddings
+
+from single_flight import SingleFlight
+
+
+class EmbeddingCache:
+    """
+    A persistent, size-bounded store of embedding vectors in SQLite.
+
+    Vectors are stored under a key derived from the model name and the text,
+    and the least recently used entries are evicted once the store holds
+    more than `max_entries` vectors.
+    """
+
+    def __init__(self, path: str = ".embedding_cache.sqlite3", max_entries: int = 200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items.items()],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an `Embeddings` backend with an `EmbeddingCache`: only the texts
+    that are not cached yet are sent to the backend, in batches, so a file
+    whose chunks were all embedded before costs no embedding call at all.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache: Optional[EmbeddingCache] = None,
+        model: Optional[str] = None,
+        batch_size: int = 500,
+    ):
+        self.embeddings = embeddings
+        if cache is None:
+            cache = EmbeddingCache(os.environ.get("EMBEDDING_CACHE_PATH", ".embedding_cache.sqlite3"))
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        # Sessions embedding the same query at the same time share one call
+        self.single_flight = SingleFlight()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        vectors = self.cache.get_many(list(set(keys)))
+
+        # Identical chunks are only embedded once
+        missing = {}  # type: Dict[str, str]
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        missing_keys = list(missing)
+        for start in range(0, len(missing_keys), self.batch_size):
+            batch = missing_keys[start : start + self.batch_size]
+            embedded = self.embeddings.embed_documents([missing[key] for key in batch])
+            new_vectors = dict(zip(batch, embedded))
+            self.cache.put_many(new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = EmbeddingCache.key(self.model, text)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            self.hits += 1
+            return cached[key]
+        self.misses += 1
+
+        def embed() -> List[float]:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many({key: vector})
+            return vector
+
+        return self.single_flight.do_sync(key, embed)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.cache),
+            "coalesced": self.single_flight.coalesced,
+        }
@@ -0,0 +1,259 @@
+import asyncio
+import inspect
+import json
+import types
+from typing import (
+    Annotated,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Union,
+    get_args,
+    get_origin,
+    get_type_hints,
+)
+
+_JSON_TYPES = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    list: "array",
+    dict: "object",
+}
+
+_PYTHON_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "array": (list,),
+    "object": (dict,),
+}
+
+
+class ArgumentError(ValueError):
+    pass
+
+
+def _parameter_schema(annotation) -> dict:
+    schema = {}
+    if get_origin(annotation) is Annotated:
+        annotation, *extras = get_args(annotation)
+        descriptions = [extra for extra in extras if isinstance(extra, str)]
+        if descriptions:
+            schema["description"] = descriptions[0]
+    if get_origin(annotation) in (Union, types.UnionType):
+        # Optional[X] is sent as X, a missing or null value is always allowed
+        annotation = next(arg for arg in get_args(annotation) if arg is not type(None))
+    if get_origin(annotation) is Literal:
+        values = list(get_args(annotation))
+        schema["type"] = _JSON_TYPES[type(values[0])]
+        schema["enum"] = values
+    else:
+        schema["type"] = _JSON_TYPES.get(get_origin(annotation) or annotation, "string")
+    return schema
+
+
+def function_schema(function: Callable, description: Optional[str] = None) -> dict:
+    """
+    The OpenAI `functions` entry of `function`. Parameter types come from its
+    annotations: `Annotated[str, "..."]` adds a description and `Literal`
+    values become an enum. Parameters without a default are required.
+    """
+    hints = get_type_hints(function, include_extras=True)
+    properties = {}
+    required = []
+    for name, parameter in inspect.signature(function).parameters.items():
+        properties[name] = _parameter_schema(hints.get(name, str))
+        if parameter.default is inspect.Parameter.empty:
+            required.append(name)
+    parameters = {"type": "object", "properties": properties}
+    if required:
+        parameters["required"] = required
+    return {
+        "name": function.__name__,
+        "description": description or inspect.getdoc(function) or "",
+        "parameters": parameters,
+    }
+
+
+class RegisteredFunction:
+    def __init__(self, function: Callable, schema: dict, pure: bool):
+        self.function = function
+        self.schema = schema
+        # Side-effect free functions may be started before the model is done
+        self.pure = pure
+
+    @property
+    def name(self) -> str:
+        return self.schema["name"]
+
+    def validate_property(self, name: str, value: Any):
+        properties = self.schema["parameters"]["properties"]
+        if name not in properties:
+            raise ArgumentError(f"{self.name} has no parameter {name!r}")
+        schema = properties[name]
+        # bool is an int subclass, but not a JSON integer
+        if value is None or (isinstance(value, bool) and schema["type"] != "boolean"):
+            valid = value is None
+        else:
+            valid = isinstance(value, _PYTHON_TYPES[schema["type"]])
+        if not valid:
+            raise ArgumentError(f"{name} of {self.name} must be of type {schema['type']}")
+        if "enum" in schema and value not in schema["enum"]:
+            raise ArgumentError(f"{name} of {self.name} must be one of {schema['enum']}")
+
+    def validate(self, arguments: Any):
+        if not isinstance(arguments, dict):
+            raise ArgumentError(f"The arguments of {self.name} must be a JSON object")
+        for name, value in arguments.items():
+            self.validate_property(name, value)
+        missing = [
+            name
+            for name in self.schema["parameters"].get("required", [])
+            if name not in arguments
+        ]
+        if missing:
+            raise ArgumentError(f"{self.name} is missing {', '.join(missing)}")
+
+
+class FunctionRegistry:
+    """
+    The functions the model may call, with their schemas derived from the
+    Python callables. Calls are validated against the schemas and a call the
+    model got wrong becomes an error response it can correct, instead of an
+    exception.
+    """
+
+    def __init__(self):
+        self._functions = {}  # type: Dict[str, RegisteredFunction]
+
+    def register(self, description: Optional[str] = None, pure: bool = False):
+        def decorator(function: Callable) -> Callable:
+            schema = function_schema(function, description)
+            self._functions[schema["name"]] = RegisteredFunction(function, schema, pure)
+            return function
+
+        return decorator
+
+    def get(self, name: str) -> Optional[RegisteredFunction]:
+        return self._functions.get(name)
+
+    def schemas(self) -> List[dict]:
+        return [function.schema for function in self._functions.values()]
+
+    def parser(self, name: str) -> "ArgumentParser":
+        return ArgumentParser(self, name)
+
+    async def call(self, name: str, arguments: Any) -> str:
+        function = self._functions.get(name)
+        try:
+            if function is None:
+                raise ArgumentError(f"Unknown function {name!r}")
+            function.validate(arguments)
+            if inspect.iscoroutinefunction(function.function):
+                result = await function.function(**arguments)
+            else:
+                result = await asyncio.to_thread(function.function, **arguments)
+        except Exception as e:
+            return error_response(e)
+        return result if isinstance(result, str) else json.dumps(result)
+
+
+def error_response(error: Exception) -> str:
+    return json.dumps({"error": str(error)})
+
+
+class ArgumentParser:
+    """
+    Parses the JSON arguments of a function call as they stream in. Every
+    top-level property is validated as soon as its value is complete, so a
+    wrong call is caught before the model finishes writing it, and `complete`
+    is set once the closing brace arrived.
+    """
+
+    def __init__(self, registry: FunctionRegistry, name: str):
+        self.function = registry.get(name)
+        self.name = name
+        self.text = ""
+        self.arguments = None  # type: Optional[dict]
+        self.error = None  # type: Optional[Exception]
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._property_start = None  # type: Optional[int]
+        if self.function is None:
+            self.error = ArgumentError(f"Unknown function {name!r}")
+
+    @property
+    def complete(self) -> bool:
+        return self.arguments is not None
+
+    def feed(self, fragment: str):
+        if self.error is not None or self.complete:
+            return
+        start = len(self.text)
+        self.text += fragment
+        try:
+            for i in range(start, len(self.text)):
+                self._scan(i)
+                if self.complete:
+                    break
+        except (ArgumentError, ValueError) as e:
+            self.error = e if isinstance(e, ArgumentError) else ArgumentError(f"Invalid JSON: {e}")
+
+    def _scan(self, i: int):
+        char = self.text[i]
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+            return
+        if char == '"':
+            self._in_string = True
+        elif char in "{[":
+            self._depth += 1
+            if self._depth == 1:
+                self._property_start = i + 1
+        elif char in "}]":
+            self._depth -= 1
+            if self._depth == 0:
+                self._end_property(i)
+                arguments = json.loads(self.text[: i + 1])
+                self.function.validate(arguments)
+                self.arguments = arguments
+        elif char == "," and self._depth == 1:
+            self._end_property(i)
+            self._property_start = i + 1
+
+    def _end_property(self, end: int):
+        pair = self.text[self._property_start : end]
+        if not pair.strip():
+            return
+        for name, value in json.loads("{" + pair + "}").items():
+            self.function.validate_property(name, value)
+
+    def finish(self) -> dict:
+        """
+        The parsed arguments, or raise if the call is invalid. An empty
+        argument string means a call without arguments.
+        """
+        if self.error is None and not self.complete:
+            if self.text.strip():
+                self.error = ArgumentError(f"The arguments of {self.name} are incomplete")
+            else:
+                try:
+                    self.function.validate({})
+                    self.arguments = {}
+                except ArgumentError as e:
+                    self.error = e
+        if self.error is not None:
+            raise self.error
+        return self.arguments
@@ -20,11 +20,13 @@ class KnowledgeGraph(BaseModel):
     
 from openai import OpenAI
 import instructor
+from clients import http_client
 api_key = os.environ.get("OPENAI_API_KEY")
 # Adds response_model to ChatCompletion
 # Allows the return of Pydantic model rather than raw JSON
+# instructor patches the client in place, so only the connection pool is shared
 
-client = instructor.patch(OpenAI(api_key=api_key))
+client = instructor.patch(OpenAI(api_key=api_key, http_client=http_client()))
 
 def generate_graph(input) -> KnowledgeGraph:
     return client.chat.completions.create(
@@ -0,0 +1,151 @@
+import json
+import threading
+from typing import Dict, List, Optional
+
+from context_packer import SUMMARY_PREFIX, count_tokens, summarize_text, truncate_tokens
+
+# Per-session size of every live history, for operators
+_stats_lock = threading.Lock()
+_session_stats = {}  # type: Dict[str, dict]
+
+
+def history_stats() -> Dict[str, dict]:
+    with _stats_lock:
+        return {session_id: dict(stats) for session_id, stats in _session_stats.items()}
+
+
+def forget_session(session_id: str):
+    with _stats_lock:
+        _session_stats.pop(session_id, None)
+
+
+class HistoryManager:
+    """
+    The chat-completion message history of one session, kept within a token
+    budget.
+
+    The system prompt and the most recent turns are sent verbatim. Older
+    turns are folded into a short summary and dropped from the history, and
+    bulky function results outside of the current turn are cut down to
+    `function_result_tokens`.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        max_tokens: int = 6000,
+        summary_tokens: int = 300,
+        function_result_tokens: int = 200,
+        model: str = "gpt-4-1106-preview",
+        session_id: Optional[str] = None,
+    ):
+        self.system = {"role": "system", "content": system_prompt}
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.function_result_tokens = function_result_tokens
+        self.model = model
+        self.session_id = session_id
+        self.summary_lines = []  # type: List[str]
+        self.history = []  # type: List[dict]
+        self.compacted_messages = 0
+
+    def append(self, message: dict):
+        self.history.append(message)
+        self._compact()
+        self._record()
+
+    def messages(self) -> List[dict]:
+        """
+        The messages to send to the model.
+        """
+        messages = [self.system]
+        if self.summary_lines:
+            messages.append(
+                {"role": "system", "content": SUMMARY_PREFIX + "\n" + "\n".join(self.summary_lines)}
+            )
+        return messages + self.history
+
+    def tokens(self, messages: Optional[List[dict]] = None) -> int:
+        return sum(self._count(message) for message in (messages or self.messages()))
+
+    def stats(self) -> dict:
+        return {
+            "messages": len(self.history),
+            "compacted_messages": self.compacted_messages,
+            "tokens": self.tokens(),
+            "bytes": sum(len(json.dumps(message)) for message in self.messages()),
+        }
+
+    def _count(self, message: dict) -> int:
+        text = message.get("content") or ""
+        if message.get("name"):
+            text += message["name"]
+        if message.get("function_call"):
+            text += json.dumps(message["function_call"])
+        # Every message costs a few tokens of framing on top of its content
+        return count_tokens(text, self.model) + 4
+
+    def _turns(self) -> List[List[dict]]:
+        # A turn starts with a user message, so function calls and their
+        # results are never split apart
+        turns = []  # type: List[List[dict]]
+        for message in self.history:
+            if message["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+
+    def _compact(self):
+        turns = self._turns()
+        # Function results of earlier turns have already been answered
+        for turn in turns[:-1]:
+            for i, message in enumerate(turn):
+                if message["role"] == "function":
+                    content = message.get("content") or ""
+                    short = truncate_tokens(content, self.function_result_tokens, self.model)
+                    if short != content:
+                        turn[i] = {**message, "content": short}
+
+        budget = self.max_tokens - self._count(self.system) - self.summary_tokens
+        kept = []  # type: List[List[dict]]
+        used = 0
+        for turn in reversed(turns):
+            tokens = sum(self._count(message) for message in turn)
+            # The current turn is always kept whole
+            if kept and used + tokens > budget:
+                break
+            kept.insert(0, turn)
+            used += tokens
+
+        for turn in turns[: len(turns) - len(kept)]:
+            self.summary_lines.append(self._summarize(turn))
+            self.compacted_messages += len(turn)
+        # The oldest summary lines go first when the summary is over budget
+        while (
+            self.summary_lines
+            and count_tokens("\n".join(self.summary_lines), self.model) > self.summary_tokens
+        ):
+            self.summary_lines.pop(0)
+
+        self.history = [message for turn in kept for message in turn]
+
+    def _summarize(self, turn: List[dict]) -> str:
+        parts = []
+        for message in turn:
+            if message.get("function_call"):
+                call = message["function_call"]
+                parts.append(f"assistant called {call.get('name')}({call.get('arguments', '')})")
+            elif message["role"] == "function":
+                result = summarize_text(message.get("content") or "", 30, self.model)
+                parts.append(f"{message.get('name')} returned {result}")
+            elif message.get("content"):
+                content = summarize_text(message["content"], 30, self.model)
+                parts.append(f"{message['role']}: {content}")
+        return "; ".join(parts)
+
+    def _record(self):
+        if self.session_id is None:
+            return
+        stats = self.stats()
+        with _stats_lock:
+            _session_stats[self.session_id] = stats
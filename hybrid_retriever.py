@@ -0,0 +1,258 @@
+import math
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+# Identifiers such as ERR_CONN_REFUSED, 0x80070005 or v2.3.1 are kept whole,
+# and their parts are indexed as well
+TOKEN_PATTERN = re.compile(r"\w+(?:[.\-:/]\w+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        tokens.append(token)
+        parts = re.split(r"[.\-:/_]", token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+
+class BM25Index:
+    """
+    A local inverted index over the chunks of a collection, scored with
+    Okapi BM25. Chunks can be added while the index is being searched.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._documents = []  # type: List[Document]
+        self._lengths = []  # type: List[int]
+        self._postings = defaultdict(dict)  # type: Dict[str, Dict[int, int]]
+        self._total_length = 0
+
+    def add_texts(self, texts: List[str], metadatas: Optional[List[dict]] = None):
+        metadatas = metadatas or [{} for _ in texts]
+        with self._lock:
+            for text, metadata in zip(texts, metadatas):
+                doc_id = len(self._documents)
+                tokens = tokenize(text)
+                self._documents.append(Document(page_content=text, metadata=metadata))
+                self._lengths.append(len(tokens))
+                self._total_length += len(tokens)
+                for term, count in Counter(tokens).items():
+                    self._postings[term][doc_id] = count
+
+    def search(self, query: str, k: int = 20) -> List[Document]:
+        with self._lock:
+            count = len(self._documents)
+            if not count:
+                return []
+            average_length = self._total_length / count
+            scores = defaultdict(float)  # type: Dict[int, float]
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / average_length)
+                    scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            best = sorted(scores, key=scores.get, reverse=True)[:k]
+            return [self._documents[doc_id] for doc_id in best]
+
+    def resident_bytes(self) -> int:
+        """
+        Approximate bytes held by the index: the text of its chunks, its
+        terms and their postings.
+        """
+        with self._lock:
+            texts = sum(len(document.page_content.encode("utf-8")) for document in self._documents)
+            postings = sum(
+                sys.getsizeof(term) + sys.getsizeof(documents) for term, documents in self._postings.items()
+            )
+            return texts + postings + sys.getsizeof(self._postings) + sys.getsizeof(self._lengths)
+
+    def __len__(self):
+        return len(self._documents)
+
+
+class TermOverlapReranker:
+    """
+    A lightweight reranker: candidates containing more of the query terms
+    come first, the fused ranking breaks ties.
+    """
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        terms = set(tokenize(query))
+        if not terms:
+            return documents
+
+        def coverage(document: Document):
+            return len(terms & set(tokenize(document.page_content))) / len(terms)
+
+        return sorted(documents, key=coverage, reverse=True)
+
+
+class CrossEncoderReranker:
+    """
+    Reranks candidates with a local cross-encoder from sentence-transformers,
+    which is not part of requirements.txt and only needed for this reranker.
+    """
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError:
+            raise ImportError(
+                "CrossEncoderReranker needs sentence-transformers, "
+                "install it with `pip install sentence-transformers`"
+            )
+        self.model = CrossEncoder(model_name)
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        if not documents:
+            return documents
+        scores = self.model.predict([(query, document.page_content) for document in documents])
+        ranked = sorted(zip(scores, range(len(documents))), reverse=True)
+        return [documents[i] for _, i in ranked]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses dense results from a vector store with BM25 results over the same
+    chunks using reciprocal rank fusion, optionally reranks the fused
+    candidates and returns the best `k`.
+    """
+
+    vectorstore: Any
+    lexical_index: BM25Index
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+    reranker: Optional[Any] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        dense = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        lexical = self.lexical_index.search(query, k=self.fetch_k)
+
+        scores = defaultdict(float)  # type: Dict[str, float]
+        documents = {}  # type: Dict[str, Document]
+        for results in (dense, lexical):
+            for rank, document in enumerate(results):
+                scores[document.page_content] += 1 / (self.rrf_k + rank + 1)
+                documents.setdefault(document.page_content, document)
+
+        fused = [documents[text] for text in sorted(scores, key=scores.get, reverse=True)]
+        if self.reranker is not None:
+            fused = self.reranker.rerank(query, fused[: self.fetch_k])
+        return fused[: self.k]
+
+
+def make_reranker(name: Optional[str]):
+    if not name or name == "none":
+        return None
+    if name == "overlap":
+        return TermOverlapReranker()
+    if name == "cross-encoder":
+        return CrossEncoderReranker()
+    raise ValueError(f"Unknown reranker: {name}")
+
+
+def benchmark(k: int = 4, queries_per_kind: int = 100):
+    """
+    Recall@k and p95 latency of dense-only, BM25-only and hybrid retrieval
+    on a generated fixture corpus of runbook chunks that mention error codes.
+    Dense retrieval is approximated with hashed character trigrams of the
+    text without its digits, which blurs exact identifiers the way embedding
+    models do, so this runs locally without an embedding model.
+    """
+    import random
+    import zlib
+
+    import numpy as np
+
+    random.seed(7)
+    topics = ["database", "network", "storage", "login", "billing", "cache", "queue", "upload"]
+    verbs = ["fails", "times out", "is slow", "returns errors", "crashes", "hangs"]
+    filler = (
+        "Check the service logs, restart the worker and confirm the dashboards "
+        "recover. Escalate to the on-call engineer if the issue persists. "
+    )
+    texts, code_queries, topic_queries = [], [], []
+    for i in range(2000):
+        topic, verb = random.choice(topics), random.choice(verbs)
+        code = f"E{random.randint(1000, 9999)}_{topic.upper()}"
+        texts.append(f"When the {topic} {verb}, the client reports {code}. " + filler * 3)
+        code_queries.append((f"what does {code} mean", i))
+        topic_queries.append((f"the {topic} {verb}, what should I do about {code}", i))
+
+    def embed(text):
+        vector = np.zeros(256, dtype=np.float32)
+        text = re.sub(r"\d", "", text.lower())
+        for j in range(len(text) - 2):
+            # hash() of a str differs between runs, crc32 keeps the results comparable
+            vector[zlib.crc32(text[j : j + 3].encode("utf-8")) % 256] += 1.0
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    class MemoryStore:
+        def __init__(self, texts):
+            self.texts = texts
+            self.vectors = np.stack([embed(text) for text in texts])
+
+        def similarity_search(self, query, k=4):
+            scores = self.vectors @ embed(query)
+            best = np.argsort(-scores)[:k]
+            return [Document(page_content=self.texts[j]) for j in best]
+
+    store = MemoryStore(texts)
+    lexical = BM25Index()
+    lexical.add_texts(texts)
+    queries = random.sample(code_queries, queries_per_kind) + random.sample(
+        topic_queries, queries_per_kind
+    )
+
+    def dense(query):
+        return store.similarity_search(query, k=k)
+
+    def bm25(query):
+        return lexical.search(query, k=k)
+
+    hybrid = HybridRetriever(vectorstore=store, lexical_index=lexical, k=k)
+    reranked = HybridRetriever(
+        vectorstore=store, lexical_index=lexical, k=k, reranker=TermOverlapReranker()
+    )
+    for name, retrieve in [
+        ("dense", dense),
+        ("bm25", bm25),
+        ("hybrid", hybrid.get_relevant_documents),
+        ("hybrid+overlap", reranked.get_relevant_documents),
+    ]:
+        hits, latencies = 0, []
+        for query, expected in queries:
+            start = time.perf_counter()
+            results = retrieve(query)
+            latencies.append(time.perf_counter() - start)
+            hits += any(doc.page_content == texts[expected] for doc in results)
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"{name:>15}: recall@{k} {hits / len(queries):.2f}, p95 {p95 * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,81 @@
+import threading
+import traceback
+from typing import Callable, Dict, List, Optional
+
+from reindex import reindex
+
+
+class IndexLoader:
+    """
+    Loads the vector index persisted in `persist_dir` in a background
+    thread, so the app can serve while the index warms up. Files of
+    `data_dir` added, changed or removed since the index was persisted are
+    re-indexed first, see `reindex`.
+
+    `reader` replaces the default `SimpleDirectoryReader` of every file, e.g.
+    to use other file extractors. The seconds spent in every phase of the
+    startup are kept in `timings`.
+    """
+
+    def __init__(
+        self,
+        persist_dir: str = "./storage",
+        data_dir: str = "./data",
+        reader: Optional[Callable[[List[str]], List[List]]] = None,
+    ):
+        self.persist_dir = persist_dir
+        self.data_dir = data_dir
+        self.reader = reader
+        # idle, loading, ready or failed
+        self.state = "idle"
+        self.error = None  # type: Optional[BaseException]
+        self.timings = {}  # type: Dict[str, float]
+        self._index = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self) -> "IndexLoader":
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="index-loader", daemon=True)
+                self._thread.start()
+        return self
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def wait(self, timeout: Optional[float] = None):
+        """
+        The index, once it is loaded. Raises the error of the startup if it
+        failed and `TimeoutError` if it is not ready within `timeout`.
+        """
+        self.start()
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"The index is still {self.state}")
+        if self.error is not None:
+            raise self.error
+        return self._index
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "timings": dict(self.timings),
+            "error": repr(self.error) if self.error is not None else None,
+        }
+
+    def _run(self):
+        try:
+            self.state = "loading"
+            self._index, report = reindex(self.data_dir, self.persist_dir, self.reader)
+            self.timings = report.pop("timings")
+            print("REINDEX", report)
+            self.state = "ready"
+        except BaseException as e:
+            self.error = e
+            self.state = "failed"
+            traceback.print_exc()
+        finally:
+            self._done.set()
+            print("INDEX STARTUP", self.status())
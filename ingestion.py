@@ -0,0 +1,126 @@
+import asyncio
+import codecs
+import io
+import os
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+READ_SIZE = 64 * 1024
+
+
+def open_upload(file) -> BinaryIO:
+    """
+    Open a Chainlit upload for reading, from disk when Chainlit saved it
+    there, so the file never has to be held in memory as a whole.
+    """
+    path = getattr(file, "path", None)
+    if path and os.path.exists(path):
+        return open(path, "rb")
+    return io.BytesIO(file.content)
+
+
+def upload_size(file) -> int:
+    size = getattr(file, "size", None)
+    if size:
+        return size
+    path = getattr(file, "path", None)
+    if path and os.path.exists(path):
+        return os.path.getsize(path)
+    return len(file.content)
+
+
+def iter_chunks(stream: BinaryIO, text_splitter, read_size: int = READ_SIZE) -> Iterator[str]:
+    """
+    Decode and split `stream` a window at a time. The last chunk of every
+    window may have been cut short by the window boundary, so the raw text
+    it came from is carried over and split again together with the next
+    window. Chunks are whitespace-stripped, carrying the chunk itself would
+    glue the words on both sides of the boundary together.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    carry = ""
+    while True:
+        data = stream.read(read_size)
+        text = carry + decoder.decode(data, final=not data)
+        if not data:
+            if text:
+                yield from text_splitter.split_text(text)
+            return
+        chunks = text_splitter.split_text(text)
+        if not chunks:
+            carry = text
+            continue
+        yield from chunks[:-1]
+        start = text.rfind(chunks[-1])
+        carry = text[start:] if start >= 0 else chunks[-1]
+
+
+class IngestionPipeline:
+    """
+    Splits an upload and adds it to one or more stores (the vector store and
+    its lexical index) in batches of `batch_size` chunks. Splitting runs ahead
+    of embedding by at most `max_pending` batches, so memory stays flat
+    however large the file is.
+
+    `on_batch` is awaited after every batch that landed in the store with the
+    number of chunks indexed so far and the fraction of the file read.
+    """
+
+    def __init__(
+        self,
+        text_splitter,
+        batch_size: int = 64,
+        max_pending: int = 2,
+        read_size: int = READ_SIZE,
+    ):
+        self.text_splitter = text_splitter
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.read_size = read_size
+
+    async def run(
+        self,
+        stream: BinaryIO,
+        size: int,
+        stores: list,
+        on_batch: Optional[Callable] = None,
+    ) -> int:
+        queue = asyncio.Queue(maxsize=self.max_pending)
+        chunks = iter_chunks(stream, self.text_splitter, self.read_size)
+
+        def next_batch() -> List[str]:
+            batch = []
+            for chunk in chunks:
+                batch.append(chunk)
+                if len(batch) == self.batch_size:
+                    break
+            return batch
+
+        async def produce():
+            try:
+                while True:
+                    batch = await asyncio.to_thread(next_batch)
+                    if not batch:
+                        break
+                    await queue.put((batch, stream.tell()))
+            finally:
+                await queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        indexed = 0
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                texts, position = item
+                # Create a metadata for each chunk
+                metadatas = [{"source": f"{indexed + i}-pl"} for i in range(len(texts))]
+                for store in stores:
+                    await asyncio.to_thread(store.add_texts, texts, metadatas=metadatas)
+                indexed += len(texts)
+                if on_batch is not None:
+                    await on_batch(indexed, min(position / size, 1.0) if size else 1.0)
+            await producer
+        finally:
+            producer.cancel()
+        return indexed
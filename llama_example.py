@@ -1,4 +1,5 @@
 import os
+import time
 import openai
 
 from llama_index.response.schema import Response, StreamingResponse
@@ -7,74 +8,95 @@ from llama_index.callbacks.base import CallbackManager
 from llama_index import (
     LLMPredictor,
     ServiceContext,
-    StorageContext,
-    load_index_from_storage,
 )
 from langchain.chat_models import ChatOpenAI
 import chainlit as cl
-from llama_index.agent import OpenAIAgent
-from llama_index.tools import QueryEngineTool
-# agent = OpenAIAgent.from_tools(tools=[query_engine_tool], verbose=True)
+from streaming import TokenStreamBuffer, stream_stats
+from single_flight import Replay, SingleFlight
+from clients import use_pool
+from scheduler import request_context, scheduler
+from index_store import IndexLoader
+from query_engine_pool import QueryEnginePool
+from async_bridge import AsyncBridge
 
 STREAMING = True
+# Sessions asking the same question at the same time share one query
+single_flight = SingleFlight()
 
-try:
-    # rebuild storage context
-    storage_context = StorageContext.from_defaults(persist_dir="./storage")
-    # load index
-    index = load_index_from_storage(storage_context)
-except:
-    from llama_index import GPTVectorStoreIndex, SimpleDirectoryReader
+# Load the index in the background, so Chainlit serves right away
+index_loader = IndexLoader(persist_dir="./storage", data_dir="./data").start()
 
-    documents = SimpleDirectoryReader("./data").load_data()
-    index = GPTVectorStoreIndex.from_documents(documents)
-    index.storage_context.persist()
 
-
-@cl.on_chat_start
-async def factory():
+def create_service_context():
     llm_predictor = LLMPredictor(
-        llm=ChatOpenAI(
-            temperature=0,
-            model_name="gpt-3.5-turbo",
-            streaming=STREAMING,
+        llm=use_pool(
+            ChatOpenAI(
+                temperature=0,
+                model_name="gpt-3.5-turbo",
+                streaming=STREAMING,
+            )
         ),
     )
-    service_context = ServiceContext.from_defaults(
+    return ServiceContext.from_defaults(
         llm_predictor=llm_predictor,
         chunk_size=512,
-        callback_manager=CallbackManager([cl.LlamaIndexCallbackHandler()]),
     )
 
-    query_engine = index.as_query_engine(
-        service_context=service_context,
-        streaming=STREAMING,
-    )
-    
-    query_engine_tool = QueryEngineTool.from_defaults(
-        query_engine=query_engine,
-        name="query_tool",
-        description=(
-            "Useful for questions needing context from the documents."
-    ),
-)
+
+# The index and LLM are shared, sessions only get their own retriever, synthesizer and engine
+engine_pool = QueryEnginePool(index_loader, create_service_context, streaming=STREAMING)
 
 
-    agent = OpenAIAgent.from_tools(tools=[query_engine_tool], verbose=True)
-    cl.user_session.set("agent", agent)
+async def create_query_engine():
+    callback_manager = CallbackManager([cl.LlamaIndexCallbackHandler()])
+    query_engine = await cl.make_async(engine_pool.session_engine)(callback_manager)
     cl.user_session.set("query_engine", query_engine)
+    print("QUERY ENGINE POOL", engine_pool.stats())
+    return query_engine
+
+
+@cl.on_chat_start
+async def factory():
     cl.user_session.set(
         "message_history",
         [{"role": "system", "content": "You are a helpful QA assistant. you are specialised to know extra context about local files."}],
     )
+    if engine_pool.ready:
+        await create_query_engine()
+    elif index_loader.state == "failed":
+        await cl.Message(content=f"The document index could not be loaded: {index_loader.error}").send()
+    else:
+        # The query engine is created with the first question once the index is there
+        await cl.Message(
+            content="The document index is still warming up, your first answer may take a little longer."
+        ).send()
 
 
 @cl.on_message
 async def main(message: cl.Message):
     query_engine = cl.user_session.get("query_engine")  # type: RetrieverQueryEngine
+    if query_engine is None:
+        try:
+            query_engine = await create_query_engine()
+        except Exception as e:
+            await cl.Message(content=f"The document index could not be loaded: {e}").send()
+            return
     message_history = cl.user_session.get("message_history")
     message_history.append({"role": "user", "content": message.content})
-    response = await cl.make_async(query_engine.query)(message.content)
+    session_id = cl.user_session.get("id")
+    started = time.perf_counter()
+
+    def query():
+        with request_context(session=session_id):
+            response = query_engine.query(message.content)
+        if isinstance(response, StreamingResponse):
+            # Every session sharing the query reads all of its tokens, generation stops once all of them left
+            response.response_gen = Replay(response.response_gen)
+        return response
+
+    response = await cl.make_async(single_flight.do_sync)(
+        single_flight.key(question=message.content, streaming=STREAMING), query
+    )
 
     response_message = cl.Message(content="")
 
@@ -82,11 +104,27 @@ async def main(message: cl.Message):
         response_message.content = str(response)
         await response_message.send()
     elif isinstance(response, StreamingResponse):
-        gen = response.response_gen
-        for token in gen:
-            await response_message.stream_token(token=token)
+        # Tokens are awaited on a worker thread, not on the event loop
+        tokens = AsyncBridge(response.response_gen.subscribe(), started=started)
+        cl.user_session.set("tokens", tokens)
+        response_stream = TokenStreamBuffer(response_message)
+        async for token in tokens:
+            await response_stream.push(token)
+        await response_stream.close()
+        print("STREAMING", response_stream.stats(), stream_stats())
+        print("TOKENS", tokens.stats())
+        print("SINGLE FLIGHT", single_flight.stats())
+        print("SCHEDULER", scheduler.stats())
 
         if response.response_txt:
             response_message.content = response.response_txt
 
-        await response_message.send()
\ No newline at end of file
+        await response_message.send()
+
+
+@cl.on_chat_end
+async def end():
+    # Stop reading the answer of a user that is gone
+    tokens = cl.user_session.get("tokens")  # type: AsyncBridge
+    if tokens is not None:
+        tokens.cancel()
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import pickle
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from llama_index import SimpleDirectoryReader
+
+from reindex import hash_file
+
+# File extractors of the worker process, built once per process
+_file_extractor = None  # type: Optional[dict]
+
+
+def unstructured_extractor() -> dict:
+    """
+    Parse PDFs with the UnstructuredReader, as speechtt.py does.
+    """
+    from llama_hub.file.unstructured.base import UnstructuredReader
+
+    return {".pdf": UnstructuredReader()}
+
+
+def _init_worker(file_extractor_factory: Optional[Callable[[], dict]]):
+    global _file_extractor
+    _file_extractor = file_extractor_factory() if file_extractor_factory else None
+
+
+def _parse(path: str) -> List:
+    return SimpleDirectoryReader(input_files=[path], file_extractor=_file_extractor).load_data()
+
+
+class ParallelReader:
+    """
+    Parses files into documents on a pool of `workers` processes, as parsing
+    PDFs is CPU bound. Documents come back in the order of the paths.
+
+    Parsed documents are cached in `cache_dir` by the path and the content
+    hash of the file, so a file that did not change is never parsed again,
+    even when it was touched or restored with an older mtime; the documents
+    carry the path in their metadata, so a copy of the file elsewhere is
+    parsed on its own. Callers that hashed the files already, as `reindex`
+    does, pass the hashes along and files are not read twice. At most
+    `max_cached` files are kept, the least recently used are removed. The file extractors
+    are built in every worker by `file_extractor_factory`, which has to be a
+    module-level function so it can be sent to the workers.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        cache_dir: Optional[str] = ".parse_cache",
+        file_extractor_factory: Optional[Callable[[], dict]] = None,
+        max_cached: int = 1024,
+    ):
+        self.workers = workers or int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+        self.cache_dir = cache_dir
+        self.file_extractor_factory = file_extractor_factory
+        self.max_cached = max_cached
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, path: str, digest: Optional[str] = None) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        extractor = getattr(self.file_extractor_factory, "__qualname__", "default")
+        digest = digest or hash_file(path)
+        key = hashlib.sha256(
+            f"{os.path.abspath(path)}\0{digest}\0{extractor}".encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def _evict(self):
+        # Every change of a file leaves its previous entry behind, the oldest go first
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".pkl"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        for _, path in entries[: max(len(entries) - self.max_cached, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __call__(self, paths: List[str], hashes: Optional[List[str]] = None) -> List[List]:
+        """
+        The documents of every file of `paths`, in the same order. `hashes`
+        are the `hash_file` digests of the files, if the caller has them.
+        """
+        documents = [None] * len(paths)  # type: List[Optional[List]]
+        hashes = hashes or [None] * len(paths)
+        cache_paths = [self._cache_path(path, digest) for path, digest in zip(paths, hashes)]
+        missing = []  # type: List[int]
+        for i, cache_path in enumerate(cache_paths):
+            if cache_path is not None and os.path.exists(cache_path):
+                with open(cache_path, "rb") as f:
+                    documents[i] = pickle.load(f)
+                # Marks the entry as used for `_evict`
+                os.utime(cache_path)
+                # Every insert needs its own document ids
+                for document in documents[i]:
+                    document.id_ = str(uuid.uuid4())
+            else:
+                missing.append(i)
+        self.hits += len(paths) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            parsed = self._parse([paths[i] for i in missing])
+            for i, file_documents in zip(missing, parsed):
+                documents[i] = file_documents
+                if cache_paths[i] is not None:
+                    # Written aside and renamed, so readers never see half a file
+                    tmp = f"{cache_paths[i]}.{os.getpid()}.tmp"
+                    with open(tmp, "wb") as f:
+                        pickle.dump(file_documents, f)
+                    os.replace(tmp, cache_paths[i])
+            if self.cache_dir is not None:
+                self._evict()
+        return documents
+
+    def _parse(self, paths: List[str]) -> List[List]:
+        if self.workers <= 1 or len(paths) == 1:
+            _init_worker(self.file_extractor_factory)
+            return [_parse(path) for path in paths]
+        with ProcessPoolExecutor(
+            max_workers=min(self.workers, len(paths)),
+            initializer=_init_worker,
+            initargs=(self.file_extractor_factory,),
+        ) as pool:
+            return list(pool.map(_parse, paths))
+
+    def stats(self) -> Dict[str, int]:
+        return {"workers": self.workers, "hits": self.hits, "misses": self.misses}
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from typing import List
 
@@ -14,12 +15,34 @@ from langchain.prompts.chat import (
     HumanMessagePromptTemplate,
 )
 from langchain.docstore.document import Document
-from langchain.memory import ChatMessageHistory, ConversationBufferMemory
+from langchain.memory import ChatMessageHistory
 
 import chainlit as cl
+from clients import use_pool
+from embedding_cache import CachedEmbeddings
+from collection_manager import CollectionManager, file_hash
+from ingestion import IngestionPipeline, open_upload, upload_size
+from hybrid_retriever import HybridRetriever, make_reranker
+from context_packer import ContextPacker, PackedConversationMemory, PackedRetriever
+from scheduler import BACKGROUND, request_context, scheduler
 
 
 text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+# Shared by every session, so a chunk is only ever embedded once per model
+embeddings = CachedEmbeddings(use_pool(OpenAIEmbeddings()))
+# Sessions uploading the same file share its collection
+collections = CollectionManager(
+    embeddings,
+    ttl=float(os.environ.get("QA_COLLECTION_TTL", 600)),
+    persist_dir=os.environ.get("QA_PERSIST_DIR"),
+)
+ingestion = IngestionPipeline(text_splitter, batch_size=64, max_pending=2)
+# Number of chunks handed to the chain, and the optional reranking stage
+# ("overlap" or "cross-encoder") applied to the fused candidates
+retriever_k = int(os.environ.get("QA_RETRIEVER_K", 4))
+reranker = make_reranker(os.environ.get("QA_RERANKER"))
+# Token budget for the history and retrieved chunks of every question
+context_tokens = int(os.environ.get("QA_CONTEXT_TOKENS", 3000))
 
 @cl.on_chat_start
 async def on_chat_start():
@@ -41,52 +64,124 @@ async def on_chat_start():
     )
     await msg.send()
 
-    # Decode the file
-    text = file.content.decode("utf-8")
-
-    # Split the text into chunks
-    texts = text_splitter.split_text(text)
-
-    # Create a metadata for each chunk
-    metadatas = [{"source": f"{i}-pl"} for i in range(len(texts))]
-
-    # Create a Chroma vector store
-    embeddings = OpenAIEmbeddings()
-    docsearch = await cl.make_async(Chroma.from_texts)(
-        texts, embeddings, metadatas=metadatas
-    )
+    # Get the shared Chroma vector store of this file, creating it if needed
+    stream = open_upload(file)
+    collection_key = await cl.make_async(file_hash)(stream)
+    collection, needs_fill = await cl.make_async(collections.acquire)(collection_key)
+    cl.user_session.set("collection", collection)
+
+    if needs_fill:
+        first_batch = asyncio.Event()
+
+        async def on_batch(indexed: int, progress: float):
+            collections.batch_indexed(collection_key)
+            first_batch.set()
+            msg.content = (
+                f"Processing `{file.name}`: {progress:.0%} ({indexed} chunks) indexed. "
+                "You can already ask questions!"
+            )
+            await msg.update()
+
+        async def ingest():
+            try:
+                # Split and embed the file batch by batch, straight into the store,
+                # giving way to the questions of every session
+                with request_context(priority=BACKGROUND, session=collection_key):
+                    await ingestion.run(
+                        stream, upload_size(file), [collection.store, collection.lexical], on_batch
+                    )
+                collections.complete(collection_key)
+            except Exception as e:
+                # Nobody awaits this task: the sessions of the file find the error on the collection
+                collections.discard(collection_key, e)
+                msg.content = f"Processing `{file.name}` failed, please upload it again."
+                await msg.update()
+                return
+            except BaseException as e:
+                collections.discard(collection_key, e)
+                raise
+            finally:
+                stream.close()
+                first_batch.set()
+
+            msg.content = f"Processing `{file.name}` done. You can now ask questions!"
+            await msg.update()
+            print("EMBEDDING CACHE", embeddings.stats())
+            print("COLLECTION MEMORY", collections.memory_usage())
+
+        # Keep indexing in the background once the first batch is searchable
+        task = asyncio.create_task(ingest())
+        cl.user_session.set("ingestion_task", task)
+        await first_batch.wait()
+    else:
+        stream.close()
+        await cl.make_async(collection.first_batch.wait)()
+    # Set by a failed or cancelled fill, without asking the task for its exception
+    if collection.error is not None:
+        raise RuntimeError(f"Processing `{file.name}` failed") from collection.error
+
+    docsearch = collection.store
 
     message_history = ChatMessageHistory()
+    packer = ContextPacker(max_tokens=context_tokens, model="gpt-3.5-turbo")
 
-    memory = ConversationBufferMemory(
+    memory = PackedConversationMemory(
         memory_key="chat_history",
         output_key="answer",
         chat_memory=message_history,
         return_messages=True,
+        packer=packer,
     )
 
     # Create a chain that uses the Chroma vector store
     chain = ConversationalRetrievalChain.from_llm(
-        ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0, streaming=True),
+        use_pool(ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0, streaming=True)),
         chain_type="stuff",
-        retriever=docsearch.as_retriever(),
+        retriever=PackedRetriever(
+            retriever=HybridRetriever(
+                vectorstore=docsearch,
+                lexical_index=collection.lexical,
+                k=retriever_k,
+                reranker=reranker,
+            ),
+            packer=packer,
+        ),
         memory=memory,
         return_source_documents=True,
     )
 
     # Let the user know that the system is ready
-    msg.content = f"Processing `{file.name}` done. You can now ask questions!"
-    await msg.update()
+    if collection.ready.is_set():
+        msg.content = f"Processing `{file.name}` done. You can now ask questions!"
+        await msg.update()
 
     cl.user_session.set("chain", chain)
+    cl.user_session.set("packer", packer)
+
+
+@cl.on_chat_end
+def on_chat_end():
+    collection = cl.user_session.get("collection")
+    if collection:
+        collections.release(collection)
 
 
 @cl.on_message
 async def main(message: cl.Message):
     chain = cl.user_session.get("chain")  # type: ConversationalRetrievalChain
+    collection = cl.user_session.get("collection")
+    if collection.error is not None:
+        # Indexing failed after the first batch, the chain would answer from part of the file
+        await cl.Message(
+            content="Processing the file failed, please start a new chat and upload it again."
+        ).send()
+        return
     cb = cl.AsyncLangchainCallbackHandler()
 
-    res = await chain.acall(message.content, callbacks=[cb])
+    with request_context(session=cl.user_session.get("id")):
+        res = await chain.acall(message.content, callbacks=[cb])
+    print("CONTEXT TOKENS", cl.user_session.get("packer").report())
+    print("SCHEDULER", scheduler.stats())
     answer = res["answer"]
     source_documents = res["source_documents"]  # type: List[Document]
 
@@ -0,0 +1,98 @@
+import dataclasses
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Optional
+
+from llama_index import ServiceContext
+from llama_index.callbacks.base import CallbackManager
+from llama_index.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.query_engine.retriever_query_engine import RetrieverQueryEngine
+from llama_index.response_synthesizers import get_response_synthesizer
+
+from index_store import IndexLoader
+
+
+class QueryEnginePool:
+    """
+    Hands out query engines over the index of `index_loader`.
+
+    Only the index and the service context with its LLM and embedding model
+    are built once per process and shared. Every session gets its own
+    retriever, response synthesizer and `RetrieverQueryEngine` over them,
+    which are cheap to build, bound to the session's callback manager, so
+    the retrieval and synthesis steps of its queries reach the session.
+
+    The LLM and embedding events are emitted by the shared models with the
+    callback manager of the shared service context, so they are not shown
+    as steps of the session.
+    """
+
+    def __init__(
+        self,
+        index_loader: IndexLoader,
+        create_service_context: Callable[[], ServiceContext],
+        streaming: bool = True,
+        similarity_top_k: int = 2,
+    ):
+        self.index_loader = index_loader
+        self.create_service_context = create_service_context
+        self.streaming = streaming
+        self.similarity_top_k = similarity_top_k
+        self._lock = threading.Lock()
+        self._index = None
+        self._service_context = None  # type: Optional[ServiceContext]
+        self._node_ids = None
+        self._setup_times = deque(maxlen=1000)  # type: Deque[float]
+
+    @property
+    def ready(self) -> bool:
+        return self.index_loader.ready
+
+    def _shared(self):
+        # Built by the first session, the others wait for it instead of
+        # building their own
+        with self._lock:
+            if self._index is None:
+                index = self.index_loader.wait()
+                self._service_context = self.create_service_context()
+                # The nodes `as_retriever` would list for every retriever
+                self._node_ids = list(index.index_struct.nodes_dict.values())
+                self._index = index
+            return self._index, self._service_context, self._node_ids
+
+    def session_engine(
+        self, callback_manager: Optional[CallbackManager] = None
+    ) -> RetrieverQueryEngine:
+        """
+        A query engine for one session. Blocks until the index is loaded.
+        The setup time includes waiting for the shared components.
+        """
+        start = time.perf_counter()
+        index, service_context, node_ids = self._shared()
+        if callback_manager is not None:
+            # A copy sharing the LLM and embedding model. `from_service_context`
+            # would set the callback manager on the shared models themselves
+            service_context = dataclasses.replace(service_context, callback_manager=callback_manager)
+        engine = RetrieverQueryEngine(
+            retriever=VectorIndexRetriever(
+                index, similarity_top_k=self.similarity_top_k, node_ids=node_ids
+            ),
+            response_synthesizer=get_response_synthesizer(
+                service_context=service_context, streaming=self.streaming
+            ),
+            callback_manager=callback_manager,
+        )
+        self._setup_times.append(time.perf_counter() - start)
+        return engine
+
+    def stats(self) -> dict:
+        times = sorted(self._setup_times)
+        return {
+            "sessions": len(times),
+            "setup_ms": {
+                "mean": round(sum(times) / len(times) * 1000, 3) if times else 0.0,
+                "p95": round(times[int(len(times) * 0.95)] * 1000, 3) if times else 0.0,
+                "max": round(times[-1] * 1000, 3) if times else 0.0,
+            },
+        }
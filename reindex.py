@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_index import (
+    GPTVectorStoreIndex,
+    SimpleDirectoryReader,
+    StorageContext,
+    load_index_from_storage,
+)
+
+# Written into the persist directory next to the index it describes
+MANIFEST = "manifest.json"
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan(data_dir: str) -> Dict[str, os.stat_result]:
+    """
+    Every file below `data_dir` by its path relative to it, skipping hidden
+    files and directories as `SimpleDirectoryReader` does.
+    """
+    files = {}
+    for root, dirs, names in os.walk(data_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, data_dir)] = os.stat(path)
+    return files
+
+
+def read_sequential(
+    paths: List[str], hashes: Optional[List[str]] = None, file_extractor: Optional[dict] = None
+) -> List[List]:
+    """
+    The documents of every file of `paths`, in the same order. `hashes` are
+    the digests of the files, which readers with a cache use as its key.
+    """
+    return [
+        SimpleDirectoryReader(input_files=[path], file_extractor=file_extractor).load_data()
+        for path in paths
+    ]
+
+
+def load_manifest(persist_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(persist_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def persist(index, persist_dir: str, manifest: dict):
+    """
+    Persist `index` and its manifest to `persist_dir`, all or nothing: both
+    are written to a temporary directory that then replaces `persist_dir`.
+    """
+    persist_dir = os.path.abspath(persist_dir)
+    tmp = tempfile.mkdtemp(
+        prefix=os.path.basename(persist_dir) + ".", dir=os.path.dirname(persist_dir)
+    )
+    try:
+        index.storage_context.persist(persist_dir=tmp)
+        with open(os.path.join(tmp, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    old = persist_dir + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(persist_dir):
+        os.rename(persist_dir, old)
+    os.rename(tmp, persist_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def reindex(
+    data_dir: str = "./data",
+    persist_dir: str = "./storage",
+    reader: Optional[Callable[..., List[List]]] = None,
+    service_context=None,
+) -> Tuple[GPTVectorStoreIndex, dict]:
+    """
+    Bring the index in `persist_dir` in line with the files of `data_dir`
+    and return it with a report of what changed and how long it took.
+
+    The manifest records the hash, mtime and size of every indexed file and
+    the ids of its documents. Files whose mtime and size did not change are
+    not even hashed; only added and changed files are read and embedded, and
+    the documents of changed and removed files are deleted from the index.
+    An index without a manifest is rebuilt from scratch. Files are read by
+    `reader(paths, hashes=digests)`, `read_sequential` by default.
+    """
+    reader = reader or read_sequential
+    timings = {}  # type: Dict[str, float]
+    start = time.perf_counter()
+
+    def lap(phase: str):
+        nonlocal start
+        now = time.perf_counter()
+        timings[phase] = round(timings.get(phase, 0) + now - start, 3)
+        start = now
+
+    # Finish a swap that was interrupted between its two renames
+    if not os.path.exists(persist_dir) and os.path.exists(os.path.abspath(persist_dir) + ".old"):
+        os.rename(os.path.abspath(persist_dir) + ".old", persist_dir)
+
+    manifest = load_manifest(persist_dir)
+    if manifest is None:
+        manifest = {"files": {}}
+        index = GPTVectorStoreIndex.from_documents([], service_context=service_context)
+    else:
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+        index = load_index_from_storage(storage_context, service_context=service_context)
+    lap("load")
+
+    entries = manifest["files"]  # type: Dict[str, dict]
+    current = scan(data_dir)
+    report = {"added": [], "changed": [], "removed": sorted(set(entries) - set(current))}
+    touched = False
+    for path, stat in current.items():
+        entry = entries.get(path)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            continue
+        digest = hash_file(os.path.join(data_dir, path))
+        if entry and entry["hash"] == digest:
+            # Touched but not modified, only the manifest needs updating
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            touched = True
+            continue
+        report["changed" if entry else "added"].append(path)
+        entries[path] = {
+            "hash": digest,
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            # The documents indexed so far, deleted before the file is re-read
+            "doc_ids": entry["doc_ids"] if entry else [],
+        }
+    lap("scan")
+
+    for path in report["removed"] + report["changed"]:
+        for doc_id in entries[path]["doc_ids"]:
+            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        if path in report["removed"]:
+            del entries[path]
+    lap("delete")
+
+    updated = report["added"] + report["changed"]
+    # The files were hashed by the scan, the reader does not need to read them again for its cache
+    documents = reader(
+        [os.path.join(data_dir, path) for path in updated],
+        hashes=[entries[path]["hash"] for path in updated],
+    )
+    lap("read")
+
+    for path, file_documents in zip(updated, documents):
+        for document in file_documents:
+            index.insert(document)
+        entries[path]["doc_ids"] = [document.doc_id for document in file_documents]
+    lap("embed")
+
+    if updated or report["removed"] or touched or not os.path.exists(persist_dir):
+        persist(index, persist_dir, manifest)
+    lap("persist")
+
+    report["unchanged"] = len(current) - len(updated)
+    report["timings"] = timings
+    return index, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the vector index of a document folder.")
+    parser.add_argument("--data", default="./data", help="folder of the documents to index")
+    parser.add_argument("--storage", default="./storage", help="folder the index is persisted in")
+    parser.add_argument(
+        "--unstructured-pdf",
+        action="store_true",
+        help="parse PDFs with the UnstructuredReader, as speechtt.py does",
+    )
+    parser.add_argument("--workers", type=int, help="processes parsing files (default: all cores)")
+    args = parser.parse_args()
+
+    from parallel_reader import ParallelReader, unstructured_extractor
+
+    reader = ParallelReader(
+        workers=args.workers,
+        file_extractor_factory=unstructured_extractor if args.unstructured_pdf else None,
+    )
+    _, report = reindex(args.data, args.storage, reader=reader)
+    report["parsing"] = reader.stats()
+    print(json.dumps(report, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema.cache import RETURN_VAL_TYPE, BaseCache
+from langchain.schema.embeddings import Embeddings
+
+
+def normalize(prompt: str) -> str:
+    return " ".join(prompt.split()).casefold()
+
+
+class ResponseCache(BaseCache):
+    """
+    A langchain LLM cache of complete responses in SQLite, for chains that
+    run deterministically (temperature 0).
+
+    Responses are looked up by the normalized prompt together with the model
+    settings. With `embeddings` and a `similarity` threshold set, a prompt
+    that misses is also matched against the cached prompts of the same
+    settings by cosine similarity. Entries expire after `ttl` seconds and the
+    least recently used ones are evicted beyond `max_entries`.
+
+    The cache sits inside the LLM call, so callback handlers still see the
+    start and end of every call whether it was answered from the cache or not.
+    Embedding prompts and SQLite block the calling thread: `alookup` and
+    `aupdate` move them to a worker thread, langchain versions that only call
+    `lookup` and `update` have to run the chain off the event loop.
+    """
+
+    def __init__(
+        self,
+        path: str = ".response_cache.sqlite3",
+        ttl: float = 24 * 3600,
+        max_entries: int = 10_000,
+        embeddings: Optional[Embeddings] = None,
+        similarity: Optional[float] = None,
+        max_pending: int = 1024,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embeddings = embeddings
+        self.similarity = similarity if embeddings is not None else None
+        self.max_pending = max_pending
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Vectors of the prompts that missed, until their response is stored.
+        # Bounded, as a failed LLM call never stores its response
+        self._pending = OrderedDict()  # type: OrderedDict[Tuple[str, str], List[float]]
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, settings TEXT NOT NULL, "
+            "response TEXT NOT NULL, vector BLOB, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_settings ON responses (settings)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def _settings(llm_string: str) -> str:
+        return hashlib.sha256(llm_string.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _key(cls, prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(
+            f"{cls._settings(llm_string)}\0{normalize(prompt)}".encode("utf-8")
+        ).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        now = time.time()
+        with self._lock:
+            # Expired entries are deleted by `update`, until then they are skipped
+            row = self._conn.execute(
+                "SELECT key, response FROM responses WHERE key = ? AND created >= ?",
+                (self._key(prompt, llm_string), now - self.ttl),
+            ).fetchone()
+        if row is None and self.similarity is not None:
+            row = self._nearest(prompt, llm_string)
+            if row is not None:
+                self.semantic_hits += 1
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        key, response = row
+        with self._lock:
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return [loads(generation) for generation in _split(response)]
+
+    async def alookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        return await asyncio.to_thread(self.lookup, prompt, llm_string)
+
+    def _nearest(self, prompt: str, llm_string: str) -> Optional[Tuple[str, str]]:
+        vector = self.embeddings.embed_query(normalize(prompt))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, response, vector FROM responses "
+                "WHERE settings = ? AND vector IS NOT NULL AND created >= ?",
+                (self._settings(llm_string), time.time() - self.ttl),
+            ).fetchall()
+        if rows:
+            matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, _, blob in rows])
+            query = np.asarray(vector, dtype=np.float32)
+            scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-10)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.similarity:
+                return rows[best][0], rows[best][1]
+        # A miss, `update` stores the vector with the response
+        with self._lock:
+            self._pending[(prompt, llm_string)] = vector
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        try:
+            with self._lock:
+                vector = self._pending.get((prompt, llm_string))
+            if vector is None and self.similarity is not None:
+                vector = self.embeddings.embed_query(normalize(prompt))
+            blob = array("f", vector).tobytes() if vector is not None else None
+            response = _join([dumps(generation) for generation in return_val])
+            now = time.time()
+            with self._lock:
+                self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(key, settings, response, vector, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (self._key(prompt, llm_string), self._settings(llm_string), response, blob, now, now),
+                )
+                self._evict()
+                self._conn.commit()
+        finally:
+            with self._lock:
+                self._pending.pop((prompt, llm_string), None)
+
+    async def aupdate(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        await asyncio.to_thread(self.update, prompt, llm_string, return_val)
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._pending.clear()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": len(self),
+        }
+
+
+# Generations are serialized one per line; dumps escapes newlines in JSON strings
+def _join(generations: List[str]) -> str:
+    return "\n".join(generations)
+
+
+def _split(response: str) -> List[str]:
+    return response.split("\n")
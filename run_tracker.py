@@ -0,0 +1,247 @@
+import asyncio
+import inspect
+from collections import Counter
+from typing import Dict, List, Optional
+
+TERMINAL_RUN_STATUSES = ("cancelled", "failed", "completed", "expired")
+FINISHED_STEP_STATUSES = ("cancelled", "failed", "completed", "expired")
+
+
+class RunUpdate:
+    """
+    A change in a run: the run itself, the steps that are new or changed
+    since the last update, and the messages those steps created or updated.
+    """
+
+    def __init__(self, run, steps=None, messages=None):
+        self.run = run
+        self.steps = steps or []
+        self.messages = messages or {}
+
+
+class RunTracker:
+    """
+    Follows an assistant run until it reaches a terminal state.
+
+    When the installed `openai` client can stream run events the run is
+    streamed, otherwise it is polled with an adaptive backoff: the interval
+    drops back to `min_interval` whenever something changes and grows up to
+    `max_interval` while nothing does.
+
+    Steps are remembered once they are finished, so every poll only fetches
+    steps that are new or still in progress, and every API call is counted
+    in `api_calls` so the cost of a run can be checked.
+    """
+
+    def __init__(
+        self,
+        client,
+        thread_id: str,
+        min_interval: float = 0.2,
+        max_interval: float = 2.0,
+        backoff: float = 1.5,
+        stream: Optional[bool] = None,
+    ):
+        self.client = client
+        self.thread_id = thread_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.stream = supports_run_streaming(client) if stream is None else stream
+        self.run = None
+        self.api_calls = Counter()
+        self.finished_steps = set()
+        self.polls = 0
+        self._cursor = None  # type: Optional[str]
+        self._fingerprints = {}  # type: Dict[str, str]
+        self._event_stream = None
+        self._submitted_tool_calls = set()
+
+    async def _call(self, name, func, **kwargs):
+        self.api_calls[name] += 1
+        return await func(**kwargs)
+
+    async def create(self, assistant_id: str):
+        runs = self.client.beta.threads.runs
+        if self.stream:
+            self._event_stream = await self._call(
+                "runs.create",
+                runs.create,
+                thread_id=self.thread_id,
+                assistant_id=assistant_id,
+                stream=True,
+            )
+        else:
+            self.run = await self._call(
+                "runs.create",
+                runs.create,
+                thread_id=self.thread_id,
+                assistant_id=assistant_id,
+            )
+        return self.run
+
+    async def submit_tool_outputs(self, tool_outputs: List[dict]):
+        """
+        Submit the outputs of a `requires_action` run once. Outputs for tool
+        calls that were already submitted are dropped.
+        """
+        tool_outputs = [
+            output
+            for output in tool_outputs
+            if output["tool_call_id"] not in self._submitted_tool_calls
+        ]
+        if not tool_outputs:
+            return
+        self._submitted_tool_calls.update(o["tool_call_id"] for o in tool_outputs)
+
+        runs = self.client.beta.threads.runs
+        kwargs = dict(thread_id=self.thread_id, run_id=self.run.id, tool_outputs=tool_outputs)
+        if self.stream:
+            self._event_stream = await self._call(
+                "runs.submit_tool_outputs", runs.submit_tool_outputs, stream=True, **kwargs
+            )
+        else:
+            self.run = await self._call(
+                "runs.submit_tool_outputs", runs.submit_tool_outputs, **kwargs
+            )
+
+    async def updates(self):
+        """
+        Yield a `RunUpdate` every time the run, one of its steps or one of
+        its messages changes, until the run reaches a terminal status.
+        """
+        if self.stream:
+            async for update in self._stream_updates():
+                yield update
+        else:
+            async for update in self._poll_updates():
+                yield update
+
+    async def _stream_updates(self):
+        while self._event_stream is not None:
+            event_stream, self._event_stream = self._event_stream, None
+            async for event in event_stream:
+                self.api_calls["stream.events"] += 1
+                name = event.event
+                data = event.data
+                if name.endswith(".delta"):
+                    continue
+                if name.startswith("thread.run.step."):
+                    if data.id in self.finished_steps:
+                        continue
+                    if data.status in FINISHED_STEP_STATUSES:
+                        self.finished_steps.add(data.id)
+                    yield RunUpdate(self.run, steps=[data])
+                elif name.startswith("thread.message."):
+                    yield RunUpdate(self.run, messages={data.id: data})
+                elif name.startswith("thread.run."):
+                    self.run = data
+                    yield RunUpdate(data)
+
+    async def _poll_updates(self):
+        runs = self.client.beta.threads.runs
+        interval = self.min_interval
+        last_status = None
+        while True:
+            self.polls += 1
+            self.run = await self._call(
+                "runs.retrieve", runs.retrieve, thread_id=self.thread_id, run_id=self.run.id
+            )
+            steps = await self._fetch_steps()
+            messages = await self._fetch_messages(steps)
+            changed_steps = [step for step in steps if self._changed(step, messages)]
+
+            changed = bool(changed_steps) or self.run.status != last_status
+            last_status = self.run.status
+            if changed:
+                yield RunUpdate(
+                    self.run,
+                    steps=changed_steps,
+                    messages={
+                        message_id: message
+                        for message_id, message in messages.items()
+                        if any(_message_id(step) == message_id for step in changed_steps)
+                    },
+                )
+
+            if self.run.status in TERMINAL_RUN_STATUSES:
+                return
+
+            if changed or self.run.status == "requires_action":
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+            await asyncio.sleep(interval)
+
+    async def _fetch_steps(self):
+        kwargs = dict(thread_id=self.thread_id, run_id=self.run.id, order="asc", limit=100)
+        if self._cursor:
+            kwargs["after"] = self._cursor
+        run_steps = await self._call(
+            "runs.steps.list", self.client.beta.threads.runs.steps.list, **kwargs
+        )
+
+        steps = [step for step in run_steps.data if step.id not in self.finished_steps]
+
+        # Steps are listed in creation order, so the cursor can move past
+        # every finished step that is not preceded by an unfinished one.
+        advance = True
+        for step in run_steps.data:
+            if step.status in FINISHED_STEP_STATUSES:
+                self.finished_steps.add(step.id)
+                if advance:
+                    self._cursor = step.id
+            else:
+                advance = False
+        return steps
+
+    async def _fetch_messages(self, steps):
+        messages = {}
+        for step in steps:
+            message_id = _message_id(step)
+            if message_id and message_id not in messages:
+                messages[message_id] = await self._call(
+                    "messages.retrieve",
+                    self.client.beta.threads.messages.retrieve,
+                    thread_id=self.thread_id,
+                    message_id=message_id,
+                )
+        return messages
+
+    def _changed(self, step, messages):
+        message_id = _message_id(step)
+        fingerprint = step.status + str(step.step_details)
+        if message_id in messages:
+            fingerprint += str(messages[message_id].content)
+        if self._fingerprints.get(step.id) == fingerprint:
+            return False
+        self._fingerprints[step.id] = fingerprint
+        return True
+
+    def stats(self):
+        return {
+            "mode": "stream" if self.stream else "poll",
+            "polls": self.polls,
+            "api_calls": sum(
+                count for name, count in self.api_calls.items() if name != "stream.events"
+            ),
+            **self.api_calls,
+        }
+
+
+def _message_id(step):
+    details = step.step_details
+    if details.type == "message_creation":
+        return details.message_creation.message_id
+    return None
+
+
+def supports_run_streaming(client) -> bool:
+    """
+    Run event streams were added to the Assistants API after the `openai`
+    release pinned in requirements.txt, so look for them instead of assuming.
+    """
+    try:
+        return "stream" in inspect.signature(client.beta.threads.runs.create).parameters
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,514 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+import httpx
+
+# Priorities of upstream calls, lower values are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+_session = contextvars.ContextVar("request_session", default=None)
+
+
+@contextmanager
+def request_context(priority: Optional[int] = None, session: Optional[str] = None):
+    """
+    Schedule the upstream calls made inside the block with `priority` and
+    queue them fairly against the calls of other sessions.
+    """
+    tokens = []
+    if priority is not None:
+        tokens.append((_priority, _priority.set(priority)))
+    if session is not None:
+        tokens.append((_session, _session.set(session)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        # Set after a 429, nothing is taken before
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """
+        Seconds until `amount` can be taken.
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        wait = (amount - self.level) / self.rate if self.level < amount else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def sync(self, remaining: float, now: float):
+        # The server's count is authoritative when it is lower than ours
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class _Ticket:
+    def __init__(self, model: str, tokens: int, grant: Callable):
+        self.model = model
+        self.tokens = tokens
+        self.priority = _priority.get()
+        self.session = _session.get()
+        self.grant = grant
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.released = False
+
+
+class Scheduler:
+    """
+    Schedules the upstream model calls of the whole process.
+
+    Every model has a requests-per-minute and a tokens-per-minute bucket, and
+    at most `max_concurrency` calls are in flight. Waiting calls are served
+    by priority, and round robin across sessions within a priority, so one
+    busy session cannot starve the others. Rate limit headers of the
+    responses keep the buckets in line with the server, and 429s and server
+    errors are retried after the reset the server asked for plus a jittered
+    backoff, while every other call of that model holds back as well.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Dict[str, float]]] = None,
+        default_rpm: float = 3500,
+        default_tpm: float = 90_000,
+        max_concurrency: int = 64,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30,
+    ):
+        self.limits = dict(limits or {})
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.RLock()
+        self._buckets = {}  # type: Dict[str, Tuple[TokenBucket, TokenBucket]]
+        # priority -> session -> tickets of that session, in arrival order
+        self._queues = {}  # type: Dict[int, OrderedDict]
+        self._in_flight = 0
+        self._timer = None  # type: Optional[threading.Timer]
+        self._timer_at = 0.0
+        self._waits = deque(maxlen=1000)  # type: Deque[float]
+        self.retries = 0
+        self.rate_limited = 0
+
+    @classmethod
+    def from_env(cls) -> "Scheduler":
+        return cls(
+            limits=json.loads(os.environ.get("OPENAI_RATE_LIMITS", "{}")),
+            default_rpm=float(os.environ.get("OPENAI_RPM", 3500)),
+            default_tpm=float(os.environ.get("OPENAI_TPM", 90_000)),
+            max_concurrency=int(os.environ.get("OPENAI_MAX_CONCURRENCY", 64)),
+        )
+
+    def configure(self, model: str, rpm: float, tpm: float):
+        with self._lock:
+            self.limits[model] = {"rpm": rpm, "tpm": tpm}
+            self._buckets.pop(model, None)
+
+    def _model_buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        if model not in self._buckets:
+            limits = self.limits.get(model, {})
+            self._buckets[model] = (
+                TokenBucket(limits.get("rpm", self.default_rpm)),
+                TokenBucket(limits.get("tpm", self.default_tpm)),
+            )
+        return self._buckets[model]
+
+    async def acquire(self, model: str, tokens: int) -> _Ticket:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        ticket = _Ticket(model, tokens, grant)
+        self._enqueue(ticket)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._cancel(ticket)
+            raise
+        return ticket
+
+    def acquire_sync(self, model: str, tokens: int) -> _Ticket:
+        # Waiting would block the event loop, and with it the calls whose release grants this one
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError(
+                "Scheduler.acquire_sync called on the event loop, "
+                "use an async client or run the call on a worker thread"
+            )
+        granted = threading.Event()
+        ticket = _Ticket(model, tokens, granted.set)
+        self._enqueue(ticket)
+        granted.wait()
+        return ticket
+
+    def release(self, ticket: _Ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _enqueue(self, ticket: _Ticket):
+        with self._lock:
+            sessions = self._queues.setdefault(ticket.priority, OrderedDict())
+            sessions.setdefault(ticket.session, deque()).append(ticket)
+            self._dispatch()
+
+    def _cancel(self, ticket: _Ticket):
+        with self._lock:
+            if ticket.granted:
+                self.release(ticket)
+                return
+            sessions = self._queues[ticket.priority]
+            sessions[ticket.session].remove(ticket)
+            if not sessions[ticket.session]:
+                del sessions[ticket.session]
+
+    def _dispatch(self):
+        now = time.monotonic()
+        wake = None
+        while self._in_flight < self.max_concurrency:
+            ticket, wait = self._next_ticket(now)
+            if wait is not None:
+                wake = wait if wake is None else min(wake, wait)
+            if ticket is None:
+                break
+            requests, tokens = self._model_buckets(ticket.model)
+            requests.take(1, now)
+            tokens.take(ticket.tokens, now)
+            self._in_flight += 1
+            self._waits.append(now - ticket.enqueued)
+            ticket.granted = True
+            ticket.grant()
+        if wake is not None:
+            self._arm_timer(now + wake)
+
+    def _next_ticket(self, now: float) -> Tuple[Optional[_Ticket], Optional[float]]:
+        # Calls of a model that is out of budget keep their order, so a later
+        # or lower priority call of that model never jumps ahead of them
+        blocked = set()
+        wake = None
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            for session in list(sessions):
+                ticket = sessions[session][0]
+                if ticket.model in blocked:
+                    continue
+                requests, tokens = self._model_buckets(ticket.model)
+                wait = max(requests.delay(1, now), tokens.delay(ticket.tokens, now))
+                if wait > 0:
+                    blocked.add(ticket.model)
+                    wake = wait if wake is None else min(wake, wait)
+                    continue
+                sessions[session].popleft()
+                if sessions[session]:
+                    # Round robin: the session goes to the back of the line
+                    sessions.move_to_end(session)
+                else:
+                    del sessions[session]
+                return ticket, wake
+        return None, wake
+
+    def _arm_timer(self, at: float):
+        if self._timer is not None and self._timer_at <= at:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_at = at
+        self._timer = threading.Timer(max(at - time.monotonic(), 0.001), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def observe(self, ticket: _Ticket, response: httpx.Response, attempt: int) -> Optional[float]:
+        """
+        Update the buckets of `ticket` from the rate limit headers of
+        `response`, and return how long to wait before retrying it, or None
+        if it is not to be retried.
+        """
+        headers = response.headers
+        now = time.monotonic()
+        with self._lock:
+            requests, tokens = self._model_buckets(ticket.model)
+            if "x-ratelimit-remaining-requests" in headers:
+                requests.sync(float(headers["x-ratelimit-remaining-requests"]), now)
+            if "x-ratelimit-remaining-tokens" in headers:
+                tokens.sync(float(headers["x-ratelimit-remaining-tokens"]), now)
+
+            if not retryable(response) or attempt >= self.max_retries:
+                return None
+            delay = self._retry_delay(attempt, retry_after(headers))
+            if response.status_code == 429:
+                self.rate_limited += 1
+                # Hold back every call of the model, not only this one
+                requests.blocked_until = max(requests.blocked_until, now + delay)
+        return delay
+
+    def observe_error(self, attempt: int) -> Optional[float]:
+        """
+        How long to wait before retrying a call whose connection failed or
+        timed out, or None if it is not to be retried.
+        """
+        with self._lock:
+            if attempt >= self.max_retries:
+                return None
+            return self._retry_delay(attempt, 0.0)
+
+    def _retry_delay(self, attempt: int, wait: float) -> float:
+        self.retries += 1
+        backoff = min(self.max_backoff, self.backoff * 2**attempt)
+        return wait + random.uniform(0, backoff)
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "queue_depth": {
+                    priority: sum(len(tickets) for tickets in sessions.values())
+                    for priority, sessions in self._queues.items()
+                },
+                "in_flight": self._in_flight,
+                "wait_ms": {
+                    "mean": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                    "p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                    "max": round(waits[-1] * 1000, 1) if waits else 0.0,
+                },
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+            }
+
+
+def _duration(value: str) -> float:
+    # Rate limit resets look like "20ms", "1s" or "6m0s"
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(number) * units[unit]
+        for number, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    )
+
+
+def retryable(response: httpx.Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def _give_up(response: httpx.Response) -> httpx.Response:
+    # The scheduler retried it already, the OpenAI SDK must not retry it once more
+    if retryable(response):
+        response.headers["x-should-retry"] = "false"
+    return response
+
+
+def retry_after(headers: httpx.Headers) -> float:
+    """
+    The seconds the server asked to wait before retrying.
+    """
+    delays = [0.0]
+    if "retry-after-ms" in headers:
+        delays.append(float(headers["retry-after-ms"]) / 1000)
+    elif headers.get("retry-after", "").replace(".", "", 1).isdigit():
+        delays.append(float(headers["retry-after"]))
+    for limit in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{limit}") == "0":
+            delays.append(_duration(headers.get(f"x-ratelimit-reset-{limit}", "")))
+    return max(delays)
+
+
+def request_cost(request: httpx.Request) -> Tuple[Optional[str], int]:
+    """
+    The model of an API request and an estimate of the tokens it uses, or
+    no model for requests that are not rate limited per model.
+    """
+    if request.method != "POST":
+        return None, 0
+    try:
+        body = json.loads(request.content)
+    except (ValueError, httpx.RequestNotRead):
+        return None, 0
+    if not isinstance(body, dict) or "model" not in body:
+        return None, 0
+    # About four characters per token, plus what the completion may add
+    prompt = body.get("messages") or body.get("input") or body.get("prompt") or ""
+    tokens = len(json.dumps(prompt)) // 4
+    if request.url.path.endswith("completions"):
+        tokens += body.get("max_tokens") or 512
+    return body["model"], tokens
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    def __init__(self, stream, release: Callable):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        yield from self.stream
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release: Callable):
+        self.stream = stream
+        self.release = release
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+
+
+class ScheduledTransport(httpx.BaseTransport):
+    """
+    Sends the model calls of a synchronous httpx client through `scheduler`.
+    The call holds its slot until the response body is closed, so streamed
+    completions count against the concurrency limit while they stream.
+
+    Model calls are retried here, on rate limits, server errors and failed
+    connections; requests without a model are left to the retries of the
+    OpenAI SDK.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, scheduler: Scheduler):
+        self.transport = transport
+        self.scheduler = scheduler
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = request_cost(request)
+        if model is None:
+            return self.transport.handle_request(request)
+        attempt = 0
+        while True:
+            ticket = self.scheduler.acquire_sync(model, tokens)
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError:
+                self.scheduler.release(ticket)
+                delay = self.scheduler.observe_error(attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.scheduler.release(ticket)
+                raise
+            delay = self.scheduler.observe(ticket, response, attempt)
+            if delay is None and response.is_closed:
+                # The body was read already, nothing holds the slot anymore
+                self.scheduler.release(ticket)
+                return _give_up(response)
+            if delay is None:
+                response.stream = _ReleasingStream(
+                    response.stream, lambda: self.scheduler.release(ticket)
+                )
+                return _give_up(response)
+            response.close()
+            self.scheduler.release(ticket)
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncScheduledTransport(httpx.AsyncBaseTransport):
+    """
+    `ScheduledTransport` for asynchronous httpx clients.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, scheduler: Scheduler):
+        self.transport = transport
+        self.scheduler = scheduler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = request_cost(request)
+        if model is None:
+            return await self.transport.handle_async_request(request)
+        attempt = 0
+        while True:
+            ticket = await self.scheduler.acquire(model, tokens)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError:
+                self.scheduler.release(ticket)
+                delay = self.scheduler.observe_error(attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.scheduler.release(ticket)
+                raise
+            delay = self.scheduler.observe(ticket, response, attempt)
+            if delay is None and response.is_closed:
+                # The body was read already, nothing holds the slot anymore
+                self.scheduler.release(ticket)
+                return _give_up(response)
+            if delay is None:
+                response.stream = _AsyncReleasingStream(
+                    response.stream, lambda: self.scheduler.release(ticket)
+                )
+                return _give_up(response)
+            await response.aclose()
+            self.scheduler.release(ticket)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+# The scheduler of the process, shared by every pooled client
+scheduler = Scheduler.from_env()
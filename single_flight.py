@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import threading
+from collections import Counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List
+
+
+class _Flight:
+    def __init__(self):
+        # Sessions that joined the call instead of starting their own
+        self.joined = 0
+        self.subscribers = 0
+        self.items = []  # type: List[Any]
+        self.done = False
+        self.error = None  # type: BaseException
+        self.task = None  # type: asyncio.Future
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class _SyncFlight:
+    def __init__(self):
+        self.joined = 0
+        self.result = None
+        self.error = None  # type: BaseException
+        self.event = threading.Event()
+
+
+class SingleFlight:
+    """
+    Lets concurrent identical requests share one upstream call.
+
+    The first caller of a key starts the call and everyone asking for the
+    same key while it is in flight waits for its result instead of starting
+    another one. Nothing is kept once the call finished, so this never serves
+    stale answers; it only coalesces requests that overlap in time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # type: Dict[str, _Flight]
+        self._sync_flights = {}  # type: Dict[str, _SyncFlight]
+        self.upstream_calls = 0
+        self.coalesced = 0
+        # How many calls saved how many requests
+        self.saved_per_call = Counter()
+
+    @staticmethod
+    def key(**parts) -> str:
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]) -> Any:
+        flight = self._join(key)
+        if flight.task is None:
+            flight.task = asyncio.ensure_future(self._run(key, flight, fn))
+        # A caller that is cancelled does not cancel the call of the others
+        return await asyncio.shield(flight.task)
+
+    async def _run(self, key: str, flight: _Flight, fn: Callable[[], Awaitable]) -> Any:
+        try:
+            return await fn()
+        finally:
+            self._finish(self._flights, key, flight)
+
+    async def stream(self, key: str, fn: Callable[[], Any]) -> AsyncIterator:
+        """
+        Fan a streamed response out to every caller of `key`. `fn` returns
+        an async iterator, or an awaitable of one. Callers that join late get
+        the items streamed so far first. The upstream stream is closed once
+        every caller stopped reading.
+        """
+        flight = self._join(key)
+        if flight.task is None:
+            flight.task = asyncio.create_task(self._pump(key, flight, fn))
+        flight.subscribers += 1
+        try:
+            position = 0
+            while True:
+                if position < len(flight.items):
+                    yield flight.items[position]
+                    position += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await flight.changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody reads the stream anymore, the next caller starts anew
+                self._forget(self._flights, key, flight)
+                flight.task.cancel()
+
+    async def _pump(self, key: str, flight: _Flight, fn: Callable[[], Any]):
+        upstream = None
+        try:
+            upstream = fn()
+            if inspect.isawaitable(upstream):
+                upstream = await upstream
+            async for item in upstream:
+                flight.items.append(item)
+                flight.notify()
+        except asyncio.CancelledError:
+            await _close(upstream)
+            flight.error = ConnectionAbortedError("The shared stream was closed")
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._finish(self._flights, key, flight)
+            flight.notify()
+
+    def do_sync(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        `do` for blocking calls made from several threads.
+        """
+        with self._lock:
+            flight = self._sync_flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._sync_flights[key] = _SyncFlight()
+            else:
+                flight.joined += 1
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._finish(self._sync_flights, key, flight)
+            flight.event.set()
+        return flight.result
+
+    def _join(self, key: str) -> _Flight:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.joined += 1
+                self.coalesced += 1
+        return flight
+
+    def _forget(self, flights: dict, key: str, flight):
+        with self._lock:
+            if flights.get(key) is flight:
+                del flights[key]
+
+    def _finish(self, flights: dict, key: str, flight):
+        self._forget(flights, key, flight)
+        with self._lock:
+            self.upstream_calls += 1
+            self.saved_per_call[flight.joined] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "upstream_calls": self.upstream_calls,
+                "saved_requests": self.coalesced,
+                "saved_per_call": dict(sorted(self.saved_per_call.items())),
+            }
+
+
+async def _close(upstream):
+    if upstream is None:
+        return
+    if hasattr(upstream, "aclose"):
+        await upstream.aclose()
+    elif hasattr(upstream, "response"):
+        # openai streams close through their HTTP response
+        await upstream.response.aclose()
+
+
+class Replay:
+    """
+    Lets several readers iterate the same blocking iterator, e.g. the token
+    generator of a streamed response shared through `do_sync`. Every reader
+    gets every item; whoever needs the next item first pulls it.
+
+    As `SingleFlight.stream` does, the upstream iterator is closed once
+    every reader stopped before its end; readers that subscribe after that
+    get the items read so far, then a `ConnectionAbortedError`.
+    """
+
+    def __init__(self, iterable: Iterable):
+        self._iterator = iter(iterable)
+        self._items = []  # type: List[Any]
+        self._done = False
+        self._error = None  # type: BaseException
+        self._pulling = False
+        self._subscribers = 0
+        self._condition = threading.Condition()
+
+    def subscribe(self) -> Iterator:
+        with self._condition:
+            self._subscribers += 1
+        return self._read()
+
+    def _read(self) -> Iterator:
+        position = 0
+        try:
+            while True:
+                with self._condition:
+                    while position >= len(self._items) and not self._done and self._pulling:
+                        self._condition.wait()
+                    pull = False
+                    if position < len(self._items):
+                        item = self._items[position]
+                        position += 1
+                    elif self._done:
+                        if self._error is not None:
+                            raise self._error
+                        return
+                    else:
+                        self._pulling = True
+                        pull = True
+                if pull:
+                    self._pull()
+                    continue
+                yield item
+        finally:
+            self._leave()
+
+    def _leave(self):
+        with self._condition:
+            self._subscribers -= 1
+            if self._subscribers > 0 or self._done:
+                return
+            # Nobody reads the iterator anymore, and nobody is pulling from it
+            self._error = ConnectionAbortedError("The shared stream was closed")
+            self._done = True
+            self._condition.notify_all()
+        if hasattr(self._iterator, "close"):
+            self._iterator.close()
+
+    def _pull(self):
+        try:
+            item = next(self._iterator)
+        except StopIteration:
+            with self._condition:
+                self._done = True
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._done = True
+        else:
+            with self._condition:
+                self._items.append(item)
+        finally:
+            with self._condition:
+                self._pulling = False
+                self._condition.notify_all()
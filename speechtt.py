@@ -1,18 +1,13 @@
-import time
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
 from llama_index import (
     LLMPredictor,
     ServiceContext,
-    StorageContext,
-    load_index_from_storage,
 )
-from llama_hub.file.unstructured.base import UnstructuredReader
 from llama_index.tools import QueryEngineTool
 from llama_index.agent import OpenAIAgent
 from gtts import gTTS
-from openai import OpenAI
 
 import speech_recognition as sr
 
@@ -24,26 +19,13 @@ from langchain.agents import initialize_agent
 from langchain.chains.conversation.memory import ConversationBufferMemory
 import os
 from dotenv import load_dotenv
+from reindex import reindex
+from parallel_reader import ParallelReader, unstructured_extractor
+from voice_pipeline import VoicePipeline, openai_speech, openai_transcriber, pygame_player
 
 env_found = load_dotenv(dotenv_path=os.path.join(os.getcwd(), ".env"))
 STREAMING = True
 
-try:
-    # rebuild storage context
-    storage_context = StorageContext.from_defaults(persist_dir="./storage")
-    # load index
-    index = load_index_from_storage(storage_context)
-except:
-    from llama_index import GPTVectorStoreIndex, SimpleDirectoryReader
-
-    documents = SimpleDirectoryReader(
-        input_dir="./data",
-        file_extractor={".pdf": UnstructuredReader()}
-    ).load_data()
-    index = GPTVectorStoreIndex.from_documents(documents)
-    index.storage_context.persist()
-
-
 def query_engine_tool_factory():
     llm_predictor = LLMPredictor(
         llm=ChatOpenAI(
@@ -71,95 +53,86 @@ def query_engine_tool_factory():
     )
     return query_engine_tool
 
-memory = ConversationBufferMemory(memory_key="chat_history")
-llm = ChatOpenAI(temperature=0)
-query_engine_tool = query_engine_tool_factory()
-# agent_executor = initialize_agent(
-#     [query_engine_tool.to_langchain_tool], llm, agent="conversational-react-description", memory=memory
-# )
-message_history = [
-        {"system": "You are a helpful QA assistant. you are specialised to know extra context about local files through query tool."}]
-agent = OpenAIAgent.from_tools(
-    tools=[query_engine_tool], verbose=True, chat_history=message_history)
 
 def ai_response(question):
     return agent.chat(question).response
 
+
 # Function to convert speech to text and display it on the UI
 def speech_to_text():
     file_path = filedialog.askopenfilename(filetypes=[("Audio files", "*.wav")])
-    
-    # with sr.AudioFile(file_path) as source:
-    #     audio = recognizer.record(source)
-    #     progress['value'] = 50  # Update progress bar
-    #     root.update_idletasks()  # Force update of GUI
-    client = OpenAI()
-    start_time = time.time()
-    with open(file_path, "rb") as audio_file:
-        response = client.audio.transcriptions.create(
-            model="whisper-1", 
-            file=audio_file
-        )
-        text = response.text
-    whisper_time = time.time() - start_time
-    print(f"Whisper took {whisper_time} seconds")
-    try:
-        # text = recognizer.recognize_google(audio, )
+
+    def show_text(text):
         status_label.config(text=f"Recognized Speech: {text}")
         progress['value'] = 100  # Update progress bar
         root.update_idletasks()  # Force update of GUI
-        start_time = time.time()
-        chat_response = ai_response(text)
-        response_label.config(text=f"AI Response: {chat_response}")  # Display AI response in the UI
-        ai_time = time.time() - start_time
-        print(f"AI took {ai_time} seconds")
-        import pygame
-        # Convert response text back into speech
-        start_time = time.time()
-        
-        audio_response = client.audio.speech.create(
-        model="tts-1",
-        voice="alloy",
-        input=chat_response,
-        response_format="mp3",
-        )
-
-        audio_response.stream_to_file("response.mp3")
-
-        # tts = gTTS(text=response, lang='es', )
-        # tts.save("response.mp3")
-        tts_time = time.time() - start_time
-        
-        print(f"TTS took {tts_time} seconds")
-        
-        pygame.mixer.init()
-        pygame.mixer.music.load("response.mp3")
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy() == True:
-            continue
-        pygame.mixer.quit()
 
+    answer = []
+
+    def show_sentence(sentence):
+        answer.append(sentence)
+        response_label.config(text=f"AI Response: {' '.join(answer)}")  # Display AI response in the UI
+        root.update_idletasks()
+
+    try:
+        voice.run(file_path, on_text=show_text, on_sentence=show_sentence)
     except sr.UnknownValueError:
         status_label.config(text="Could not understand audio")
     except sr.RequestError:
         status_label.config(text="Could not request results; check your network connection")
+    finally:
+        timings = voice.stats()
+        print(f"Whisper took {timings.get('transcribed')} seconds")
+        print(f"First sentence after {timings.get('first_sentence')} seconds")
+        print(f"Playback started after {timings.get('playback_started')} seconds")
+        print("VOICE PIPELINE", timings)
+
+
+# Parsing starts worker processes, which import this script again where they
+# are spawned instead of forked (Windows, macOS), so only the script itself
+# loads the index and opens the window
+if __name__ == "__main__":
+    # Load the index, embedding only the files of ./data that changed since it was persisted.
+    # PDFs are parsed on every core, and only once per version of the file
+    pdf_reader = ParallelReader(file_extractor_factory=unstructured_extractor)
+    index, reindex_report = reindex("./data", "./storage", reader=pdf_reader)
+    print("REINDEX", reindex_report, pdf_reader.stats())
+
+    memory = ConversationBufferMemory(memory_key="chat_history")
+    llm = ChatOpenAI(temperature=0)
+    query_engine_tool = query_engine_tool_factory()
+    # agent_executor = initialize_agent(
+    #     [query_engine_tool.to_langchain_tool], llm, agent="conversational-react-description", memory=memory
+    # )
+    message_history = [
+            {"system": "You are a helpful QA assistant. you are specialised to know extra context about local files through query tool."}]
+    agent = OpenAIAgent.from_tools(
+        tools=[query_engine_tool], verbose=True, chat_history=message_history)
+
+    # Speaks the answer sentence by sentence while the rest of it is generated.
+    # SPEECH_BASE_URL points the speech endpoints at a local stand-in
+    voice = VoicePipeline(
+        transcribe=openai_transcriber(),
+        answer=lambda question: agent.stream_chat(question).response_gen,
+        synthesize=openai_speech(),
+        play=pygame_player(),
+    )
 
-
-# Creating the main window
-root = tk.Tk()
-root.geometry("500x300")
-root.title("Speech to Text Converter")
-# Creating and configuring widgets
-browse_button = tk.Button(root, text="Select Audio File", command=speech_to_text)
-browse_button.pack()
-progress = ttk.Progressbar(root, length=200, mode='determinate')
-progress.pack()
-progress['value'] = 0
-status_label = tk.Label(root, text="", wraplength=250)
-status_label.pack()
-response_label = tk.Label(root, text="", wraplength=250)  # New label to display AI response
-response_label.pack()
-
-res = ai_response("Hello")
-print(res)
-root.mainloop()
\ No newline at end of file
+    # Creating the main window
+    root = tk.Tk()
+    root.geometry("500x300")
+    root.title("Speech to Text Converter")
+    # Creating and configuring widgets
+    browse_button = tk.Button(root, text="Select Audio File", command=speech_to_text)
+    browse_button.pack()
+    progress = ttk.Progressbar(root, length=200, mode='determinate')
+    progress.pack()
+    progress['value'] = 0
+    status_label = tk.Label(root, text="", wraplength=250)
+    status_label.pack()
+    response_label = tk.Label(root, text="", wraplength=250)  # New label to display AI response
+    response_label.pack()
+
+    res = ai_response("Hello")
+    print(res)
+    root.mainloop()
\ No newline at end of file
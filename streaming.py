@@ -0,0 +1,80 @@
+import asyncio
+from collections import deque
+from typing import Deque, Tuple
+
+# (tokens, emits) of the last 1000 responses streamed by this process
+_recent = deque(maxlen=1000)  # type: Deque[Tuple[int, int]]
+
+
+def stream_stats() -> dict:
+    """
+    Tokens and emits of the last 1000 responses.
+    """
+    tokens = sum(t for t, _ in _recent)
+    emits = sum(e for _, e in _recent)
+    return {
+        "responses": len(_recent),
+        "tokens": tokens,
+        "emits": emits,
+        "emits_per_response": round(emits / (len(_recent) or 1), 1),
+        "tokens_per_emit": round(tokens / (emits or 1), 1),
+    }
+
+
+class TokenStreamBuffer:
+    """
+    Coalesces streamed tokens before they are sent to a Chainlit message.
+
+    Every `stream_token` call is a websocket emit, so tokens are buffered
+    and emitted together once `window` seconds passed since the first
+    buffered token or `max_bytes` are buffered, whichever comes first.
+    Empty tokens are dropped. Call `close` when the response is complete.
+    """
+
+    def __init__(self, message, window: float = 0.05, max_bytes: int = 512):
+        self.message = message
+        self.window = window
+        self.max_bytes = max_bytes
+        self.tokens = 0
+        self.emits = 0
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._lock = asyncio.Lock()
+        self._timer = None  # type: asyncio.Task
+
+    async def push(self, token: str):
+        if not token:
+            return
+        self.tokens += 1
+        self._buffer.append(token)
+        self._buffered_bytes += len(token.encode("utf-8"))
+        if self._buffered_bytes >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            # Emit what is buffered after the window, even if no token follows
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._buffer:
+                return
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._buffered_bytes = 0
+            self.emits += 1
+            await self.message.stream_token(text)
+
+    async def close(self):
+        await self.flush()
+        _recent.append((self.tokens, self.emits))
+
+    def stats(self) -> dict:
+        return {"tokens": self.tokens, "emits": self.emits}
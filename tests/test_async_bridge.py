@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+
+from async_bridge import AsyncBridge
+
+
+def slow_tokens(n, delay, closed):
+    try:
+        for i in range(n):
+            time.sleep(delay)
+            yield i
+    finally:
+        closed.set()
+
+
+def test_yields_every_item_in_order():
+    async def consume():
+        return [item async for item in AsyncBridge(iter(range(100)), max_pending=4)]
+
+    assert asyncio.run(consume()) == list(range(100))
+
+
+def test_reraises_errors_of_the_iterable():
+    def failing():
+        yield 1
+        raise KeyError("boom")
+
+    async def consume():
+        return [item async for item in AsyncBridge(failing())]
+
+    try:
+        asyncio.run(consume())
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("KeyError was not raised")
+
+
+def test_cancel_mid_stream_ends_a_waiting_consumer():
+    closed = threading.Event()
+
+    async def consume():
+        bridge = AsyncBridge(slow_tokens(1000, 0.01, closed))
+        items = []
+
+        async def read():
+            async for item in bridge:
+                items.append(item)
+
+        reader = asyncio.create_task(read())
+        await asyncio.sleep(0.1)
+        # As on_chat_end does, from outside the consuming task
+        bridge.cancel()
+        await asyncio.wait_for(reader, timeout=2)
+        return bridge, items
+
+    bridge, items = asyncio.run(consume())
+    assert 0 < len(items) < 1000
+    assert bridge.stats()["cancelled"]
+    assert closed.wait(2)
+
+
+def test_cancel_while_the_iterable_blocks():
+    release = threading.Event()
+
+    def blocked():
+        yield 0
+        release.wait(5)
+        yield 1
+
+    async def consume():
+        bridge = AsyncBridge(blocked())
+        items = []
+
+        async def read():
+            async for item in bridge:
+                items.append(item)
+                bridge.cancel()
+
+        await asyncio.wait_for(read(), timeout=2)
+        return items
+
+    try:
+        assert asyncio.run(consume()) == [0]
+    finally:
+        release.set()
+
+
+def test_leaving_the_loop_early_closes_the_iterable():
+    closed = threading.Event()
+
+    async def consume():
+        bridge = AsyncBridge(slow_tokens(1000, 0.001, closed))
+        async for item in bridge:
+            if item == 3:
+                break
+        return bridge
+
+    bridge = asyncio.run(consume())
+    assert bridge.cancelled
+    assert closed.wait(2)
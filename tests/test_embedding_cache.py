@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("langchain")
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache  # noqa: E402
+
+
+class CountingEmbeddings:
+    model = "counting"
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        self.embedded.append(text)
+        return [float(len(text)), 1.0]
+
+
+def test_only_uncached_texts_reach_the_backend(tmp_path):
+    backend = CountingEmbeddings()
+    embeddings = CachedEmbeddings(backend, EmbeddingCache(str(tmp_path / "cache.sqlite3")), batch_size=2)
+
+    assert embeddings.embed_documents(["a", "bb", "a", "ccc"]) == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0], [3.0, 1.0]]
+    assert sorted(backend.embedded) == ["a", "bb", "ccc"]
+
+    assert embeddings.embed_documents(["ccc", "dddd"]) == [[3.0, 1.0], [4.0, 1.0]]
+    assert embeddings.embed_query("bb") == [2.0, 1.0]
+    assert sorted(backend.embedded) == ["a", "bb", "ccc", "dddd"]
+    assert embeddings.stats()["misses"] == 4
+
+    # Persisted for the next process
+    reopened = CachedEmbeddings(CountingEmbeddings(), EmbeddingCache(str(tmp_path / "cache.sqlite3")))
+    reopened.embed_documents(["a", "bb", "ccc", "dddd"])
+    assert reopened.embeddings.embedded == []
+
+
+def test_evicts_the_least_recently_used_vectors(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    cache.put_many({"a": [1.0]})
+    cache.put_many({"b": [2.0]})
+    cache.get_many(["a"])
+    cache.put_many({"c": [3.0]})
+
+    assert len(cache) == 2
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
@@ -0,0 +1,62 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+NOTEBOOK = os.path.join(os.path.dirname(os.path.dirname(__file__)), "searchium.ipynb")
+
+
+@pytest.fixture(scope="module")
+def FeatureStore():
+    # The store is defined in the notebook, next to the generation loop that uses it
+    with open(NOTEBOOK) as f:
+        cells = ["".join(cell["source"]) for cell in json.load(f)["cells"]]
+    source = next(cell for cell in cells if "class FeatureStore" in cell)
+    namespace = {"np": np, "os": os, "time": time}
+    exec(source[: source.index("def generate_video_vectors")], namespace)
+    return namespace["FeatureStore"]
+
+
+def test_resumes_after_the_last_checkpoint(FeatureStore, tmp_path):
+    vectors = np.random.default_rng(0).standard_normal((7, 4)).astype(np.float32)
+    store = FeatureStore(tmp_path, chunk_size=3)
+    for index, vector in enumerate(vectors):
+        store.add(index * 10, vector)
+    # Interrupted with one vector pending: only the two full chunks are kept
+
+    resumed = FeatureStore(tmp_path, chunk_size=3)
+    assert resumed.rows == 6
+    assert resumed.done == {0, 10, 20, 30, 40, 50}
+    np.testing.assert_array_equal(resumed.load(), vectors[:6])
+
+    resumed.add(60, vectors[6])
+    resumed.flush()
+    reopened = FeatureStore(tmp_path)
+    assert reopened.ids == [0, 10, 20, 30, 40, 50, 60]
+    np.testing.assert_array_equal(reopened.load(), vectors)
+    np.testing.assert_array_equal(np.load(reopened.path), vectors)
+
+
+def test_drops_rows_written_after_the_last_manifest(FeatureStore, tmp_path):
+    vectors = np.ones((4, 2), dtype=np.float32)
+    store = FeatureStore(tmp_path, chunk_size=2)
+    for index, vector in enumerate(vectors):
+        store.add(index, vector)
+    # A chunk whose vectors and ids were written, but not its manifest
+    with open(store.path, "ab") as f:
+        f.write(np.zeros((2, 2), dtype=np.float32).tobytes())
+    with open(store.ids_path, "a") as f:
+        f.write("4,4\n5,5\n")
+
+    resumed = FeatureStore(tmp_path)
+    assert resumed.ids == [0, 1, 2, 3]
+    assert resumed.load().shape == (4, 2)
+    assert os.path.getsize(resumed.path) == FeatureStore.HEADER_SIZE + vectors.nbytes
+
+
+def test_refuses_a_file_it_did_not_write(FeatureStore, tmp_path):
+    np.save(tmp_path / "visual_feats.npy", np.zeros((2, 2), dtype=np.float32))
+    with pytest.raises(FileExistsError):
+        FeatureStore(tmp_path)
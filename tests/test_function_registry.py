@@ -0,0 +1,73 @@
+import asyncio
+import json
+from typing import Annotated, Literal, Optional
+
+import pytest
+
+from function_registry import ArgumentError, FunctionRegistry, function_schema
+
+registry = FunctionRegistry()
+
+
+@registry.register(pure=True)
+def get_weather(
+    city: Annotated[str, "The city to report on"],
+    unit: Literal["celsius", "fahrenheit"] = "celsius",
+    days: Optional[int] = None,
+):
+    """The weather forecast of a city."""
+    return {"city": city, "unit": unit, "days": days}
+
+
+def test_schema_follows_the_annotations():
+    assert function_schema(get_weather) == {
+        "name": "get_weather",
+        "description": "The weather forecast of a city.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "city": {"description": "The city to report on", "type": "string"},
+                "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+                "days": {"type": "integer"},
+            },
+            "required": ["city"],
+        },
+    }
+
+
+def test_invalid_calls_become_error_responses():
+    def call(name, arguments):
+        return json.loads(asyncio.run(registry.call(name, arguments)))
+
+    assert call("get_weather", {"city": "Oslo", "days": 3}) == {"city": "Oslo", "unit": "celsius", "days": 3}
+    assert "error" in call("get_weather", {"unit": "celsius"})
+    assert "error" in call("get_weather", {"city": "Oslo", "unit": "kelvin"})
+    assert "error" in call("get_weather", {"city": "Oslo", "days": True})
+    assert "error" in call("get_forecast", {})
+
+
+def test_parser_validates_properties_as_they_stream_in():
+    parser = registry.parser("get_weather")
+    for fragment in ['{"ci', 'ty": "Os', 'lo, \\"N\\"", "da', 'ys": "3"', ",", ' "unit": "celsius"}']:
+        parser.feed(fragment)
+        if parser.error is not None:
+            break
+    # Caught at the comma after days, before the rest of the call arrived
+    assert isinstance(parser.error, ArgumentError)
+    assert "days" in str(parser.error)
+    assert "unit" not in parser.text
+    with pytest.raises(ArgumentError):
+        parser.finish()
+
+
+def test_parser_completes_on_the_closing_brace():
+    parser = registry.parser("get_weather")
+    for fragment in ['{"city": "{Oslo}", ', '"unit": "fahrenheit"', "}", " trailing"]:
+        parser.feed(fragment)
+    assert parser.complete
+    assert parser.finish() == {"city": "{Oslo}", "unit": "fahrenheit"}
+
+    incomplete = registry.parser("get_weather")
+    incomplete.feed('{"city": "Oslo"')
+    with pytest.raises(ArgumentError):
+        incomplete.finish()
@@ -0,0 +1,58 @@
+import io
+
+from ingestion import iter_chunks
+
+
+class WordSplitter:
+    """
+    Merges whitespace-separated words into stripped chunks of at most
+    `chunk_size` characters, as the recursive character splitter does.
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+
+    def split_text(self, text):
+        chunks, current = [], ""
+        for word in text.split(" "):
+            piece = word if not current else current + " " + word
+            if current and len(piece) > self.chunk_size:
+                chunks.append(current.strip())
+                current = word
+            else:
+                current = piece
+        if current.strip():
+            chunks.append(current.strip())
+        return [chunk for chunk in chunks if chunk]
+
+
+TEXT = " ".join(f"wörd{i} ünïcode" for i in range(300))
+
+
+def split(text, read_size, chunk_size=40):
+    stream = io.BytesIO(text.encode("utf-8"))
+    return list(iter_chunks(stream, WordSplitter(chunk_size), read_size=read_size))
+
+
+def test_window_boundaries_keep_the_words_apart():
+    expected = TEXT.split()
+    for read_size in (7, 13, 64, 100, 1000, 64 * 1024):
+        chunks = split(TEXT, read_size)
+        assert " ".join(chunks).split() == expected, read_size
+
+
+def test_boundary_right_after_a_space():
+    # The first window ends with "hello "
+    chunks = split("hello world again", read_size=6, chunk_size=100)
+    assert chunks == ["hello world again"]
+
+
+def test_multibyte_characters_across_windows():
+    text = "ä" * 50 + " " + "€" * 50
+    chunks = split(text, read_size=3, chunk_size=60)
+    assert " ".join(chunks) == text
+
+
+def test_windows_without_chunks_are_carried():
+    assert split("   ", read_size=1) == []
+    assert split("", read_size=4) == []
@@ -0,0 +1,127 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+from run_tracker import RunTracker
+
+
+def message_step(step_id, status, message_id):
+    details = SimpleNamespace(type="message_creation", message_creation=SimpleNamespace(message_id=message_id))
+    return SimpleNamespace(id=step_id, status=status, step_details=details)
+
+
+def tool_step(step_id, status):
+    return SimpleNamespace(id=step_id, status=status, step_details=SimpleNamespace(type="tool_calls", tool_calls=[]))
+
+
+# The run and its steps as seen by every poll
+POLLS = [
+    ("in_progress", [message_step("s1", "in_progress", "m1")]),
+    # s2 finishes while s1 is still writing its message
+    ("in_progress", [message_step("s1", "in_progress", "m1"), tool_step("s2", "completed")]),
+    ("in_progress", [message_step("s1", "completed", "m1"), tool_step("s2", "completed")]),
+    ("completed", [message_step("s1", "completed", "m1"), tool_step("s2", "completed"),
+                   message_step("s3", "completed", "m3")]),
+]
+
+
+class FakeClient:
+    """
+    Serves the polls above, moving to the next one on every run retrieve.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.cursors = []
+        self.poll = -1
+        runs = SimpleNamespace(
+            create=self.create,
+            retrieve=self.retrieve,
+            steps=SimpleNamespace(list=self.list_steps, retrieve=self.retrieve_step),
+        )
+        self.beta = SimpleNamespace(
+            threads=SimpleNamespace(runs=runs, messages=SimpleNamespace(retrieve=self.retrieve_message))
+        )
+
+    async def create(self, thread_id, assistant_id):
+        self.calls["runs.create"] += 1
+        return SimpleNamespace(id="r1", status="queued")
+
+    async def retrieve(self, thread_id, run_id):
+        self.calls["runs.retrieve"] += 1
+        self.poll = min(self.poll + 1, len(POLLS) - 1)
+        return SimpleNamespace(id=run_id, status=POLLS[self.poll][0])
+
+    async def list_steps(self, thread_id, run_id, order, limit=20, after=None):
+        self.calls["runs.steps.list"] += 1
+        self.cursors.append(after)
+        steps = POLLS[self.poll][1]
+        if after is not None:
+            steps = steps[[step.id for step in steps].index(after) + 1:]
+        return SimpleNamespace(data=steps[:limit])
+
+    async def retrieve_step(self, thread_id, run_id, step_id):
+        self.calls["runs.steps.retrieve"] += 1
+        return next(step for step in POLLS[self.poll][1] if step.id == step_id)
+
+    async def retrieve_message(self, thread_id, message_id):
+        self.calls["messages.retrieve"] += 1
+        return SimpleNamespace(id=message_id, content="Hello from " + message_id)
+
+
+async def poll_everything(client, run):
+    # The loop app2 used before RunTracker, without its one second sleep
+    while True:
+        run = await client.beta.threads.runs.retrieve(thread_id="t1", run_id=run.id)
+        run_steps = await client.beta.threads.runs.steps.list(thread_id="t1", run_id=run.id, order="asc")
+        for step in run_steps.data:
+            run_step = await client.beta.threads.runs.steps.retrieve(thread_id="t1", run_id=run.id, step_id=step.id)
+            if run_step.step_details.type == "message_creation":
+                await client.beta.threads.messages.retrieve(
+                    message_id=run_step.step_details.message_creation.message_id, thread_id="t1"
+                )
+        if run.status in ["cancelled", "failed", "completed", "expired"]:
+            return
+
+
+def track(client):
+    async def main():
+        tracker = RunTracker(client, "t1", min_interval=0, stream=False)
+        await tracker.create("a1")
+        return tracker, [update async for update in tracker.updates()]
+
+    return asyncio.run(main())
+
+
+def test_polls_only_new_and_unfinished_steps():
+    client = FakeClient()
+    tracker, updates = track(client)
+
+    assert [[step.id for step in update.steps] for update in updates] == [["s1"], ["s2"], ["s1"], ["s3"]]
+    assert updates[-1].run.status == "completed"
+    assert set(updates[-1].messages) == {"m3"}
+
+    # One run and one step list call per poll, and no step retrieves
+    assert client.calls["runs.retrieve"] == client.calls["runs.steps.list"] == tracker.polls == len(POLLS)
+    assert client.calls["runs.steps.retrieve"] == 0
+    # The cursor stays before s1 until it finishes, then moves past every finished step
+    assert client.cursors == [None, None, None, "s2"]
+    assert tracker.finished_steps == {"s1", "s2", "s3"}
+    # m1 is fetched while s1 is unfinished and once as it finishes, s2 is finished when first listed
+    assert client.calls["messages.retrieve"] == 4
+    assert tracker.api_calls == client.calls
+
+
+def test_makes_fewer_calls_than_polling_everything():
+    client = FakeClient()
+    track(client)
+
+    polled = FakeClient()
+    asyncio.run(poll_everything(polled, asyncio.run(polled.create("t1", "a1"))))
+
+    assert polled.calls["runs.retrieve"] == client.calls["runs.retrieve"]
+    # Every poll retrieved every step listed so far, and the message of every message step
+    assert polled.calls["runs.steps.retrieve"] == 1 + 2 + 2 + 3
+    assert polled.calls["messages.retrieve"] == 1 + 1 + 1 + 2
+    assert sum(client.calls.values()) == 13
+    assert sum(polled.calls.values()) == 22
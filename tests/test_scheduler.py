@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+from scheduler import ScheduledTransport, Scheduler
+
+
+def test_acquire_sync_refuses_to_block_the_event_loop():
+    scheduler = Scheduler(max_concurrency=1)
+
+    async def acquire():
+        scheduler.acquire_sync("gpt-3.5-turbo", 10)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(acquire())
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_acquire_sync_waits_for_a_release_from_the_event_loop():
+    scheduler = Scheduler(max_concurrency=1)
+    granted = threading.Event()
+
+    async def main():
+        ticket = await scheduler.acquire("gpt-3.5-turbo", 10)
+        waiter = asyncio.create_task(
+            asyncio.to_thread(lambda: (scheduler.acquire_sync("gpt-3.5-turbo", 10), granted.set()))
+        )
+        await asyncio.sleep(0.05)
+        assert not granted.is_set()
+        scheduler.release(ticket)
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(main())
+    assert granted.is_set()
+
+
+def scheduled_client(handler, max_retries=2):
+    scheduler = Scheduler(max_retries=max_retries, backoff=0.001)
+    return scheduler, httpx.Client(transport=ScheduledTransport(httpx.MockTransport(handler), scheduler))
+
+
+def test_model_calls_are_retried_after_connection_errors():
+    attempts = []
+
+    def handler(request):
+        attempts.append(request)
+        if len(attempts) < 3:
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200, json={"ok": True})
+
+    scheduler, client = scheduled_client(handler)
+    response = client.post("https://api.test/v1/chat/completions", json={"model": "m", "messages": []})
+    assert response.json() == {"ok": True}
+    assert len(attempts) == 3
+    assert scheduler.stats()["in_flight"] == 0
+
+    attempts.clear()
+    scheduler, client = scheduled_client(handler, max_retries=1)
+    with pytest.raises(httpx.ConnectError):
+        client.post("https://api.test/v1/chat/completions", json={"model": "m", "messages": []})
+    assert len(attempts) == 2
+
+
+def test_only_unscheduled_failures_are_left_to_the_sdk():
+    attempts = []
+
+    def handler(request):
+        attempts.append(request)
+        return httpx.Response(429, json={"error": "slow down"})
+
+    _, client = scheduled_client(handler)
+    response = client.post("https://api.test/v1/chat/completions", json={"model": "m", "messages": []})
+    assert len(attempts) == 3
+    assert response.headers["x-should-retry"] == "false"
+
+    attempts.clear()
+    response = client.get("https://api.test/v1/threads/t/runs/r")
+    assert len(attempts) == 1
+    assert "x-should-retry" not in response.headers
@@ -0,0 +1,53 @@
+import pytest
+
+from single_flight import Replay
+
+
+class Upstream:
+    def __init__(self, items):
+        self.items = iter(items)
+        self.pulled = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.pulled += 1
+        return next(self.items)
+
+    def close(self):
+        self.closed = True
+
+
+def test_every_reader_gets_every_item():
+    upstream = Upstream("abc")
+    replay = Replay(upstream)
+    first, second = replay.subscribe(), replay.subscribe()
+
+    assert next(first) == "a"
+    assert list(second) == ["a", "b", "c"]
+    assert list(first) == ["b", "c"]
+    # Every item was pulled once, plus the end of the iterator
+    assert upstream.pulled == 4
+    assert not upstream.closed
+
+
+def test_closes_the_upstream_once_every_reader_left():
+    upstream = Upstream("abcdef")
+    replay = Replay(upstream)
+    first, second = replay.subscribe(), replay.subscribe()
+    assert next(first) == "a"
+    assert next(second) == "a"
+
+    first.close()
+    assert not upstream.closed
+    assert next(second) == "b"
+    second.close()
+    assert upstream.closed
+    assert upstream.pulled == 2
+
+    late = replay.subscribe()
+    assert [next(late), next(late)] == ["a", "b"]
+    with pytest.raises(ConnectionAbortedError):
+        next(late)
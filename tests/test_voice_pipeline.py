@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from voice_pipeline import VoicePipeline, split_sentences
+
+SENTENCES = [
+    "The first sentence is the slowest one to speak.",
+    "The second sentence follows right after it.",
+    "The third and last sentence ends the answer.",
+]
+
+
+def test_split_sentences():
+    tokens = ["Yes. ", "No. ", "That is the ", "whole answer. ", "It costs 3", ".5 dollars, e.g. ", "on Mondays.", "\nOk"]
+    assert list(split_sentences(tokens, min_chars=20)) == [
+        "Yes. No. That is the whole answer.",
+        "It costs 3.5 dollars, e.g. on Mondays.",
+        "Ok",
+    ]
+
+
+class Speaker:
+    """
+    The speech endpoints of a pipeline: the answer is streamed word by word,
+    and the first sentence takes the longest to synthesize.
+    """
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.played = []
+        self.first_played = threading.Event()
+        self.played_before_answered = None
+
+    def answer(self, text):
+        for index, sentence in enumerate(SENTENCES):
+            for word in sentence.split(" "):
+                yield word + " "
+            if index == 1:
+                # The first sentence is complete, playing it must not wait for the rest of the answer
+                self.played_before_answered = self.first_played.wait(2)
+
+    def synthesize(self, sentence):
+        time.sleep(0.1 if sentence == SENTENCES[0] else 0.01)
+        if sentence == self.fail_on:
+            raise IOError("speech endpoint unavailable")
+        return sentence.encode()
+
+    def play(self, audio):
+        self.played.append(audio.decode())
+        self.first_played.set()
+
+    def pipeline(self):
+        return VoicePipeline(
+            lambda path: "question", self.answer, self.synthesize, self.play, tts_workers=3
+        )
+
+
+def test_plays_the_sentences_in_order_while_answering():
+    speaker = Speaker()
+    pipeline = speaker.pipeline()
+
+    assert pipeline.run("question.wav") == " ".join(SENTENCES)
+    assert speaker.played == SENTENCES
+    assert speaker.played_before_answered
+    assert pipeline.stats()["sentences"] == 3
+
+
+def test_raises_synthesis_errors():
+    speaker = Speaker(fail_on=SENTENCES[1])
+
+    with pytest.raises(IOError):
+        speaker.pipeline().run("question.wav")
+    assert speaker.played == SENTENCES[:1]
@@ -0,0 +1,90 @@
+import asyncio
+import contextvars
+import json
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional
+
+
+class ToolExecutor:
+    """
+    Runs the function tool calls of an assistant run in parallel. Tools with
+    a coroutine are awaited on the event loop, the others run off the event
+    loop on a shared worker pool.
+
+    Every call gets a timeout (`timeouts` per tool name, `timeout` otherwise)
+    and a failing or timed out call is reported back to the assistant as an
+    error output, so one slow tool never holds the other outputs back.
+    """
+
+    def __init__(
+        self,
+        tools,
+        max_workers: int = 8,
+        timeout: float = 60.0,
+        timeouts: Optional[Dict[str, float]] = None,
+    ):
+        self.tool_map = {tool.name: tool for tool in tools if hasattr(tool, "name")}
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        # Latencies of the last 1000 calls of every tool
+        self.latencies = defaultdict(lambda: deque(maxlen=1000))  # type: Dict[str, Deque[float]]
+        self.calls = Counter()  # type: Counter[str]
+
+    async def run(self, tool_calls) -> List[dict]:
+        """
+        Execute every function tool call and return the outputs in the
+        format expected by `submit_tool_outputs`, in the order of `tool_calls`.
+        """
+        function_calls = [tool_call for tool_call in tool_calls if tool_call.type == "function"]
+        outputs = await asyncio.gather(*[self._run_one(tool_call) for tool_call in function_calls])
+        return [
+            {"tool_call_id": tool_call.id, "output": output}
+            for tool_call, output in zip(function_calls, outputs)
+        ]
+
+    async def _run_one(self, tool_call) -> str:
+        function_name = tool_call.function.name
+        tool = self.tool_map.get(function_name)
+        if tool is None:
+            return f"Error: unknown tool {function_name}"
+
+        timeout = self.timeouts.get(function_name, self.timeout)
+        start = time.perf_counter()
+        try:
+            arguments = json.loads(tool_call.function.arguments)
+            if getattr(tool, "coroutine", None) is not None:
+                pending = tool.ainvoke(arguments)
+            else:
+                # Tools read the Chainlit user session, which lives in context variables
+                ctx = contextvars.copy_context()
+                loop = asyncio.get_running_loop()
+                pending = loop.run_in_executor(self.pool, ctx.run, tool.invoke, arguments)
+            output = await asyncio.wait_for(pending, timeout=timeout)
+        except asyncio.TimeoutError:
+            output = f"Error: {function_name} timed out after {timeout} seconds"
+        except Exception as e:
+            output = f"Error: {function_name} failed: {e}"
+        finally:
+            latency = time.perf_counter() - start
+            self.latencies[function_name].append(latency)
+            self.calls[function_name] += 1
+
+        print(function_name, tool_call.function.arguments, output, f"({latency:.3f}s)", end="\n\n")
+        return str(output)
+
+    def stats(self):
+        """
+        Calls of every tool since the start, and their average and maximum
+        latency over the last 1000 calls.
+        """
+        return {
+            name: {
+                "calls": self.calls[name],
+                "avg_s": round(sum(latencies) / len(latencies), 3),
+                "max_s": round(max(latencies), 3),
+            }
+            for name, latencies in self.latencies.items()
+        }
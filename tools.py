@@ -1,13 +1,12 @@
 import io
 import os
-from openai import OpenAI
 from langchain.tools import StructuredTool, Tool
 from io import BytesIO
-import requests
 import json
 from io import BytesIO
 import base64
 import chainlit as cl
+from clients import async_http_client, get_async_client, get_client, http_client
 
 
 def get_image_name():
@@ -34,9 +33,31 @@ def _generate_image(prompt: str):
     We use the OpenAI API to generate the image, and then store it in our
     user session so we can reference it later.
     """
-    client = OpenAI(api_key=cl.user_session.get("api_key"))
+    client = get_client(cl.user_session.get("api_key"))
 
-    response = client.images.generate(
+    response = client.images.generate(**_image_request(prompt))
+
+    image_payload = http_client().get(response.data[0].url)
+
+    return _store_image(image_payload.content)
+
+
+async def _agenerate_image(prompt: str):
+    """
+    Same as `_generate_image`, but on the shared async client so the event
+    loop is never blocked while DALL-E 3 works.
+    """
+    client = get_async_client(cl.user_session.get("api_key"))
+
+    response = await client.images.generate(**_image_request(prompt))
+
+    image_payload = await async_http_client().get(response.data[0].url)
+
+    return _store_image(image_payload.content)
+
+
+def _image_request(prompt: str):
+    return dict(
         model="dall-e-3",
         prompt=prompt,
         size="1024x1024",
@@ -44,11 +65,9 @@ def _generate_image(prompt: str):
         n=1,
     )
 
-    image_payload = requests.get(response.data[0].url, stream=True)
-
-    image_bytes = BytesIO(image_payload.content)
 
-    print(type(image_bytes))
+def _store_image(content: bytes):
+    image_bytes = BytesIO(content)
 
     name = get_image_name()
     cl.user_session.set(name, image_bytes.getvalue())
@@ -61,12 +80,18 @@ def generate_image(prompt: str):
     return f"Here is your image id:{image_name}."
 
 
+async def agenerate_image(prompt: str):
+    image_name = await _agenerate_image(prompt)
+    return f"Here is your image id:{image_name}."
+
+
 # this is our tool - which is what allows our agent to generate images in the first place!
 # the `description` field is of utmost imporance as it is what the LLM "brain" uses to determine
 # which tool to use for a given input.
 generate_image_format = '{{"prompt": "prompt"}}'
 generate_image_tool = Tool.from_function(
     func=generate_image,
+    coroutine=agenerate_image,
     name="GenerateImage",
     description=f"""
     Useful to create an image from a text prompt.
@@ -82,7 +107,7 @@ generate_image_tool = Tool.from_function(
 def gpt_vision_call(image_id: str):
     #cl.user_session.set("image_id", image_id)
     print("image_id", image_id)
-    client = OpenAI(api_key=cl.user_session.get("api_key"))
+    client = get_client(cl.user_session.get("api_key"))
     image_history = cl.user_session.get("image_history")
     stream = client.chat.completions.create(
         model="gpt-4-vision-preview",
@@ -93,6 +118,20 @@ def gpt_vision_call(image_id: str):
 
     return stream.choices[0].message.content
 
+
+async def agpt_vision_call(image_id: str):
+    print("image_id", image_id)
+    client = get_async_client(cl.user_session.get("api_key"))
+    image_history = cl.user_session.get("image_history")
+    stream = await client.chat.completions.create(
+        model="gpt-4-vision-preview",
+        messages=image_history,
+        max_tokens=350,
+        stream=False,
+    )
+
+    return stream.choices[0].message.content
+
 def handle_image_history(msg):
     image_history = cl.user_session.get("image_history")
     image_base64 = None
@@ -132,6 +171,7 @@ def process_images(msg: cl.Message):
 describe_image_format = '{{"image_id": "image_id"}}'
 describe_image_tool = Tool.from_function(
     func=gpt_vision_call,
+    coroutine=agpt_vision_call,
     name="DescribeImage",
     description=f"Useful to describe an image. Input should be a single string strictly in the following JSON format: {describe_image_format}",
     return_direct=False,
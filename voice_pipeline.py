@@ -0,0 +1,213 @@
+import io
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+# The end of a sentence, with closing quotes or brackets, once the next word
+# started. A period inside a number or an abbreviation without a space after
+# it does not end a sentence, nor does the period of a common abbreviation
+_ABBREVIATIONS = ("e.g", "E.g", "i.e", "I.e", "Mr", "Mrs", "Ms", "Dr", "vs")
+_SENTENCE_END = re.compile(
+    "".join(r"(?<!\b%s)" % re.escape(abbreviation) for abbreviation in _ABBREVIATIONS)
+    + r"[.!?]+[\"')\]]*\s+|\n+"
+)
+
+
+def split_sentences(tokens: Iterable[str], min_chars: int = 20) -> Iterator[str]:
+    """
+    The sentences of a stream of tokens, each as soon as it is complete.
+    Sentences shorter than `min_chars` are merged with the next one, so the
+    speech endpoint is not called for every "Yes." or "1.".
+    """
+    buffer = ""
+    for token in tokens:
+        buffer += token
+        start = 0
+        for match in _SENTENCE_END.finditer(buffer):
+            if len(buffer[start:match.end()].strip()) >= min_chars:
+                yield buffer[start:match.end()].strip()
+                start = match.end()
+        buffer = buffer[start:]
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def speech_client():
+    """
+    The OpenAI client of the speech endpoints. `SPEECH_BASE_URL` points it
+    at a local stand-in serving the same API, e.g. a local Whisper and TTS
+    server.
+    """
+    from openai import OpenAI
+
+    return OpenAI(base_url=os.environ.get("SPEECH_BASE_URL") or None)
+
+
+def openai_transcriber(client=None, model: str = "whisper-1") -> Callable[[str], str]:
+    client = client or speech_client()
+
+    def transcribe(path: str) -> str:
+        with open(path, "rb") as audio_file:
+            return client.audio.transcriptions.create(model=model, file=audio_file).text
+
+    return transcribe
+
+
+def openai_speech(
+    client=None, model: str = "tts-1", voice: str = "alloy"
+) -> Callable[[str], bytes]:
+    client = client or speech_client()
+
+    def synthesize(text: str) -> bytes:
+        return client.audio.speech.create(
+            model=model, voice=voice, input=text, response_format="mp3"
+        ).content
+
+    return synthesize
+
+
+def pygame_player() -> Callable[[bytes], None]:
+    def play(audio: bytes):
+        import pygame
+
+        if not pygame.mixer.get_init():
+            pygame.mixer.init()
+        pygame.mixer.music.load(io.BytesIO(audio))
+        pygame.mixer.music.play()
+        while pygame.mixer.music.get_busy():
+            time.sleep(0.01)
+
+    return play
+
+
+class VoicePipeline:
+    """
+    Answers a spoken question, speaking the answer sentence by sentence.
+
+    The answer is streamed and cut into sentences; every sentence goes to
+    the speech endpoint as soon as it is complete, on up to `tts_workers`
+    threads, and a player thread plays the audio in order while the rest of
+    the answer is still generated and synthesized. Playback starts after the
+    first sentence instead of after the whole answer.
+
+    All endpoints are plain callables, so local stand-ins can replace them:
+    `transcribe(path) -> text`, `answer(text) -> tokens`,
+    `synthesize(sentence) -> audio` and `play(audio)`, which blocks until
+    the audio is played.
+    """
+
+    def __init__(
+        self,
+        transcribe: Callable[[str], str],
+        answer: Callable[[str], Iterable[str]],
+        synthesize: Callable[[str], bytes],
+        play: Callable[[bytes], None],
+        tts_workers: int = 2,
+        min_sentence_chars: int = 20,
+    ):
+        self.transcribe = transcribe
+        self.answer = answer
+        self.synthesize = synthesize
+        self.play = play
+        self.tts_workers = tts_workers
+        self.min_sentence_chars = min_sentence_chars
+        # Seconds since the start of the last run, see `run`
+        self.timings = {}  # type: Dict[str, float]
+        self.sentence_timings = []  # type: List[Dict[str, float]]
+
+    def run(
+        self,
+        audio_path: str,
+        on_text: Optional[Callable[[str], None]] = None,
+        on_sentence: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """
+        Transcribe `audio_path`, answer it and speak the answer; returns the
+        answer once it is played. `on_text` gets the transcription and
+        `on_sentence` every sentence of the answer, both on the calling
+        thread.
+        """
+        start = time.perf_counter()
+        timings = self.timings = {}
+        sentence_timings = self.sentence_timings = []  # type: List[Dict[str, float]]
+
+        def mark(name: str, timings: Dict[str, float] = timings):
+            timings.setdefault(name, round(time.perf_counter() - start, 3))
+
+        text = self.transcribe(audio_path)
+        mark("transcribed")
+        if on_text:
+            on_text(text)
+
+        def synthesize(sentence: str, timings: Dict[str, float]) -> bytes:
+            tts_start = time.perf_counter()
+            audio = self.synthesize(sentence)
+            timings["tts"] = round(time.perf_counter() - tts_start, 3)
+            mark("synthesized", timings)
+            return audio
+
+        playback = queue.Queue()  # type: queue.Queue[Optional[Future]]
+        errors = []  # type: List[BaseException]
+
+        def player():
+            while True:
+                future = playback.get()
+                if future is None:
+                    return
+                try:
+                    audio = future.result()
+                    if errors:
+                        continue
+                    mark("playback_started")
+                    self.play(audio)
+                except BaseException as e:
+                    errors.append(e)
+
+        player_thread = threading.Thread(target=player, name="voice-player", daemon=True)
+        player_thread.start()
+        sentences = []
+        try:
+            with ThreadPoolExecutor(self.tts_workers, thread_name_prefix="voice-tts") as tts:
+                tokens = self.answer(text)
+                for sentence in split_sentences(self._first_token(tokens, mark), self.min_sentence_chars):
+                    if errors:
+                        break
+                    mark("first_sentence")
+                    sentence_timings.append({"chars": len(sentence)})
+                    mark("sentence", sentence_timings[-1])
+                    playback.put(tts.submit(synthesize, sentence, sentence_timings[-1]))
+                    sentences.append(sentence)
+                    if on_sentence:
+                        on_sentence(sentence)
+                mark("answered")
+        finally:
+            playback.put(None)
+            player_thread.join()
+        mark("played")
+        if errors:
+            raise errors[0]
+        return " ".join(sentences)
+
+    @staticmethod
+    def _first_token(tokens: Iterable[str], mark: Callable[[str], None]) -> Iterator[str]:
+        for token in tokens:
+            mark("first_token")
+            yield token
+
+    def stats(self) -> dict:
+        """
+        The timings of the last run, in seconds since it started: the voice
+        latency is `playback_started`, the end of the first sentence's audio
+        synthesis is `first_audio`.
+        """
+        tts = [t["tts"] for t in self.sentence_timings if "tts" in t]
+        return {
+            **self.timings,
+            "first_audio": self.sentence_timings[0].get("synthesized") if self.sentence_timings else None,
+            "sentences": len(self.sentence_timings),
+            "tts_mean": round(sum(tts) / len(tts), 3) if tts else None,
+        }